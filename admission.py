@@ -0,0 +1,144 @@
+import os
+import time
+import threading
+from concurrent.futures import Future, wait as wait_futures
+import metrics
+
+def _limit(name, running, queued):
+    return (int(os.getenv(f'{name}_CONCURRENCY', running)), int(os.getenv(f'{name}_QUEUE', queued)))
+
+# endpoint -> (requests doing the work at once, requests waiting for a turn),
+# per worker process. anything not listed (trees, blobs, commits...) is never
+# held back, so those stay fast while the expensive ones queue up
+LIMITS = {
+    "search": _limit('SEARCH', 4, 16),
+    "blame": _limit('BLAME', 4, 16),
+    # only archives and packs being built count, cached ones are plain files
+    "download": _limit('DOWNLOAD', 4, 16),
+    "upload-pack": _limit('UPLOAD_PACK', 8, 64),
+}
+# expensive requests one client can have running or waiting at once
+PER_CLIENT_CONCURRENCY = int(os.getenv('PER_CLIENT_CONCURRENCY', 4))
+# seconds a request waits for a turn before it's told to come back later
+ADMISSION_TIMEOUT = float(os.getenv('ADMISSION_TIMEOUT', 10))
+# what the 503 tells clients to wait before retrying, in seconds
+RETRY_AFTER = int(os.getenv('RETRY_AFTER', 5))
+
+class TooBusy(Exception):
+    pass
+
+_lock = threading.Lock()
+_turns = threading.Condition(_lock)
+# endpoint -> [running, waiting]
+_endpoints = {name: [0, 0] for name in LIMITS}
+# client -> requests running or waiting
+_clients = {}
+
+# key -> future of the call running for it
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def _leave(client):
+    _clients[client] -= 1
+    if not _clients[client]:
+        del _clients[client]
+
+def _join(endpoint, client):
+    # call with the lock held, counts a request as waiting for endpoint
+    running_limit, queue_limit = LIMITS[endpoint]
+    state = _endpoints[endpoint]
+    if _clients.get(client, 0) >= PER_CLIENT_CONCURRENCY:
+        metrics.inc("admission_rejected_total", endpoint=endpoint, reason="client")
+        raise TooBusy()
+    if state[0] >= running_limit and state[1] >= queue_limit:
+        metrics.inc("admission_rejected_total", endpoint=endpoint, reason="queue")
+        raise TooBusy()
+    _clients[client] = _clients.get(client, 0) + 1
+    state[1] += 1
+    return state
+
+def acquire(endpoint, client):
+    # waits for a turn and returns the function that gives it back (safe to
+    # call more than once). raises TooBusy when the client already has its
+    # share, the queue is full or the wait took too long
+    running_limit = LIMITS[endpoint][0]
+    start = time.monotonic()
+    with _lock:
+        state = _join(endpoint, client)
+        deadline = start + ADMISSION_TIMEOUT
+        try:
+            while state[0] >= running_limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    _leave(client)
+                    metrics.inc("admission_rejected_total", endpoint=endpoint, reason="timeout")
+                    raise TooBusy()
+                _turns.wait(remaining)
+        finally:
+            state[1] -= 1
+        state[0] += 1
+    metrics.observe("admission_wait_duration_seconds", time.monotonic() - start, endpoint=endpoint)
+
+    released = []
+
+    def release():
+        with _lock:
+            if released:
+                return
+            released.append(True)
+            state[0] -= 1
+            _leave(client)
+            _turns.notify_all()
+    return release
+
+def wait(endpoint, client, until):
+    # for a request waiting on one that took a turn of endpoint (the same
+    # search, the same archive being built) instead of taking its own: it
+    # counts against its client and the queue all the same, and gets
+    # TooBusy when until(timeout) comes back false
+    start = time.monotonic()
+    with _lock:
+        state = _join(endpoint, client)
+    try:
+        done = until(ADMISSION_TIMEOUT)
+    finally:
+        with _lock:
+            state[1] -= 1
+            _leave(client)
+    if not done:
+        metrics.inc("admission_rejected_total", endpoint=endpoint, reason="timeout")
+        raise TooBusy()
+    metrics.observe("admission_wait_duration_seconds", time.monotonic() - start, endpoint=endpoint)
+
+def _admitted(endpoint, client, fn, *args, **kwargs):
+    release = acquire(endpoint, client)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        release()
+
+def run(endpoint, client, key, fn, *args, **kwargs):
+    # fn(*args, **kwargs) in a turn of endpoint. identical calls (same key)
+    # running at the same time share one computation, the first one takes
+    # the turn and runs it, the rest wait for its result (or exception)
+    key = (endpoint, *key)
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = _in_flight[key] = Future()
+    if not leader:
+        metrics.inc("coalesced_requests_total", kind=endpoint)
+        wait(endpoint, client, lambda timeout: bool(wait_futures([future], timeout).done))
+        return future.result()
+
+    try:
+        result = _admitted(endpoint, client, fn, *args, **kwargs)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
@@ -1,15 +1,21 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file
+from flask import Flask, Response, make_response, render_template, stream_template, request, redirect, url_for, flash, session, send_file, abort, g
+from flask import before_render_template, template_rendered
 from functools import wraps
-from util import get_readme, get_repos, get_commits, get_commit, get_refs, get_tree, get_blob, create_bare_repo, set_repo_description, search_commits, search_files, search_code
+from util import get_readme, get_repos, get_commits, get_commit_page, get_file_log, get_commit, get_file_diff, get_blame, get_refs, resolve_ref, is_full_sha, commit_exists, get_tree, get_blob, get_blob_entry, stream_blob, highlight_blob, highlight_css, SERVER_HIGHLIGHT, HIGHLIGHT_MAX_SIZE, create_bare_repo, set_repo_description, get_archive, search_commits, search_files, search_code, run_expensive, start_push_worker, get_info_refs, upload_pack, open_repo_scope, close_repo_scope, track_read_errors
 from pathlib import Path
 from datetime import datetime
-from db import init_db, verify_user, get_repo_info, set_repo_owner, get_all_users
+from db import init_db, verify_user, get_repos_info, set_repo_owner, get_all_users, get_maintenance_runs
+import metrics
+import maintenance
+import admission
 import re
+import mimetypes
+import hashlib
+import gzip
 from dotenv import load_dotenv
 import secrets
-import tempfile
-import subprocess
+import time
 
 load_dotenv()
 
@@ -18,8 +24,77 @@ app.secret_key = secrets.token_hex()
 
 repoRoot = Path(os.getenv('REPO_ROOT'))
 
+SHA_RE = re.compile(r'[0-9a-f]{40}')
+
 init_db()
 
+# warms caches and indexes for pushes reported by the post-receive hook
+start_push_worker(repoRoot)
+# repacks and commit-graphs in the background, see maintenance.py
+maintenance.start_maintenance(repoRoot)
+
+# only scraped from the machine itself, anything that came through the
+# reverse proxy has a forwarding header
+METRICS_ALLOWED_ADDRS = ('127.0.0.1', '::1')
+
+@app.before_request
+def start_metrics():
+    g.metrics = metrics.start_request()
+
+@app.before_request
+def lease_repos():
+    # repo handles used by this request are its own until it's done
+    # (streamed pages included), then they go back to the pool
+    g.repo_scope = open_repo_scope()
+
+@app.teardown_request
+def return_repos(exc):
+    if 'repo_scope' in g:
+        close_repo_scope(g.pop('repo_scope'))
+
+@app.after_request
+def record_metrics(response):
+    if 'metrics' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        description = f"{request.method} {request.full_path} repo={(request.view_args or {}).get('repo_name')} ref={request.args.get('ref')}"
+        metrics.finish_request(g.pop('metrics'), route, request.method, response.status_code, description)
+    return response
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('template_starts', {})[template.name] = time.perf_counter()
+
+def _template_finished(sender, template, context, **extra):
+    start = g.get('template_starts', {}).pop(template.name, None)
+    if start is not None:
+        metrics.observe("template_render_duration_seconds", time.perf_counter() - start, template=template.name)
+
+before_render_template.connect(_template_started, app)
+template_rendered.connect(_template_finished, app)
+
+def _with_read_errors(fn, *args):
+    # for results shared between identical requests, every one of them has
+    # to know whether it's whole
+    with track_read_errors() as errors:
+        return fn(*args), errors
+
+def _client():
+    # nginx sets X-Real-IP, anything reaching us directly is its own address
+    return request.headers.get('X-Real-IP') or request.remote_addr
+
+@app.errorhandler(admission.TooBusy)
+def too_busy(e):
+    response = make_response(f"too many requests right now, try again in {admission.RETRY_AFTER} seconds\n", 503)
+    response.mimetype = 'text/plain'
+    response.headers['Retry-After'] = str(admission.RETRY_AFTER)
+    return response
+
+@app.route('/metrics')
+def metrics_page():
+    forwarded = request.headers.get('X-Forwarded-For') or request.headers.get('X-Real-IP')
+    if forwarded or request.remote_addr not in METRICS_ALLOWED_ADDRS:
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 def login_required(f):
     @wraps(f)
     def check_login(*args, **kwargs):
@@ -30,6 +105,75 @@ def login_required(f):
     return check_login
 
 
+# pages addressed by a full commit sha can never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def _page_version():
+    # the same commit renders differently after templates or code change, so
+    # those are part of every etag. hashed from file contents so every
+    # worker comes up with the same value
+    digest = hashlib.sha1()
+    sources = sorted(Path(app.root_path, 'templates').glob('*.html'))
+    sources += [Path(app.root_path, 'app.py'), Path(app.root_path, 'util.py')]
+    for source in sources:
+        digest.update(source.read_bytes())
+    # and so does highlighting
+    digest.update(f"{SERVER_HIGHLIGHT}\x00{HIGHLIGHT_MAX_SIZE}\x00{highlight_css()}".encode())
+    return digest.hexdigest()
+
+PAGE_VERSION = _page_version()
+
+def conditional_page(address='ref'):
+    # etag for pages that only depend on the commit they show. address is
+    # where the commit comes from: the ref query arg, a view arg holding a
+    # sha, or None for pages that depend on the refs alone
+    def decorator(f):
+        @wraps(f)
+        def check_etag(repo_name, *args, **kwargs):
+            repo_path = str(repoRoot / repo_name)
+            if address == 'ref':
+                target = request.args.get('ref', 'HEAD')
+            elif address:
+                target = kwargs[address]
+            else:
+                target = None
+            
+            # a full sha is answered without looking at the repo at all
+            immutable = target is not None and is_full_sha(target)
+            if immutable:
+                state = target
+            else:
+                # otherwise whatever the ref resolves to now, and the refs in
+                # the branch selector
+                sha = resolve_ref(repo_path, target) if target else ''
+                if sha is None:
+                    g.read_errors = []
+                    return f(repo_name, *args, **kwargs)
+                state = f"{sha}\x00{get_refs(repo_path)['version']}"
+            
+            etag = hashlib.sha1(f"{PAGE_VERSION}\x00{request.full_path}\x00{state}".encode()).hexdigest()
+            
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                with track_read_errors() as errors:
+                    g.read_errors = errors
+                    response = make_response(f(repo_name, *args, **kwargs))
+                # only a page that came out whole gets an etag, one built from
+                # reads that failed (and came back empty) or with any other
+                # status would stick in caches after git is fine again
+                if errors or response.status_code != 200:
+                    return response
+                # don't pin down a page for a commit that isn't there (yet)
+                if immutable and not commit_exists(repo_path, target):
+                    return response
+            
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if immutable else 'no-cache'
+            return response
+        return check_etag
+    return decorator
+
 # full date
 @app.template_filter('datetime')
 def format_datetime(value, format='%Y-%m-%d %H:%M'):
@@ -78,12 +222,12 @@ def format_age(value):
 @app.route("/")
 def index():
     repos = get_repos(repoRoot)
+    # add info from db to repo dicts (owner, etc), one query for all of them
+    extra_info = get_repos_info([repo['name'] for repo in repos])
     for repo in repos:
-        # add info from db to repo dict (owner, etc)
-        extra_info = get_repo_info(repo['name'])
         # some repos might not have db entry yet, so check
-        if isinstance(extra_info, dict):
-            repo.update(extra_info)
+        if repo['name'] in extra_info:
+            repo.update(extra_info[repo['name']])
     users = get_all_users()
     return render_template("index.html", 
                            repos=repos,
@@ -98,19 +242,23 @@ def add_owner(repo_name):
     return redirect(url_for('index'))
 
 @app.route("/<repo_name>/")
+@conditional_page()
 def repo_index(repo_name):
     ref = request.args.get('ref', 'HEAD')
     commits = get_commits(str(repoRoot / repo_name), ref=ref)
+    readme = get_readme(str(repoRoot / repo_name), ref)
     refs = get_refs(str(repoRoot / repo_name))
     
     return render_template("overview.html", 
                            repo_name=repo_name, 
                            commits=commits,
+                           readme=readme,
                            branches=refs["branches"],
                            tags=refs["tags"],
                            ref=ref)
 
 @app.route("/<repo_name>/readme")
+@conditional_page()
 def readme(repo_name):
     ref = request.args.get('ref', 'HEAD')
     readme = get_readme(str(repoRoot / repo_name), ref)
@@ -124,41 +272,61 @@ def readme(repo_name):
                            ref=ref)
 
 @app.route("/<repo_name>/commits")
+@conditional_page()
 def commits(repo_name):
-    page = request.args.get('page', 1, type=int)
     ref = request.args.get('ref', 'HEAD')
+    after = request.args.get('after')
+    before = request.args.get('before')
     per_page = 50
-    skip = (page - 1) * per_page
     
-    commits = get_commits(str(repoRoot / repo_name), max_count=per_page, skip=skip, ref=ref)
-    refs = get_refs(str(repoRoot / repo_name))
+    # cursors are shas, ignore anything else
+    if after and not SHA_RE.fullmatch(after):
+        after = None
+    if before and not SHA_RE.fullmatch(before):
+        before = None
     
-    has_next = len(commits) == per_page
-    has_prev = page > 1
+    commit_page = get_commit_page(str(repoRoot / repo_name), per_page=per_page, ref=ref, after=after, before=before)
+    refs = get_refs(str(repoRoot / repo_name))
     
     return render_template("commits.html", 
                          repo_name=repo_name, 
-                         commits=commits, 
-                         page=page, 
-                         has_next=has_next, 
-                         has_prev=has_prev,
+                         commits=commit_page["commits"], 
+                         page=commit_page["page"], 
+                         has_next=commit_page["has_next"], 
+                         has_prev=commit_page["has_prev"],
                          branches=refs["branches"],
                          tags=refs["tags"],
                          ref=ref)
 
 @app.route("/<repo_name>/commit/<commit_hash>")
+@conditional_page('commit_hash')
 def commit(repo_name, commit_hash):
     commit = get_commit(str(repoRoot / repo_name), commit_hash)
+    if commit is None:
+        abort(404)
     refs = get_refs(str(repoRoot / repo_name))
     
     return render_template("commit.html", 
                            repo_name=repo_name, 
                            commit=commit["commit"],
-                           diffs=commit["diffs"],
+                           files=commit["files"],
+                           stats=commit["stats"],
                            branches=refs["branches"],
                            tags=refs["tags"])
 
+# diff of one file, loaded into the commit page when opened
+@app.route("/<repo_name>/commit/<commit_hash>/diff/<path:file_path>")
+@conditional_page('commit_hash')
+def commit_file_diff(repo_name, commit_hash, file_path):
+    file_diff = get_file_diff(str(repoRoot / repo_name), commit_hash, file_path)
+    if file_diff is None:
+        abort(404)
+    
+    return render_template("diff.html",
+                           diff=file_diff["diff"])
+
 @app.route("/<repo_name>/refs")
+@conditional_page(None)
 def refs(repo_name):
     ref = request.args.get('ref', 'HEAD')
     refs = get_refs(str(repoRoot / repo_name))
@@ -171,6 +339,7 @@ def refs(repo_name):
 
 @app.route('/<repo_name>/tree')
 @app.route('/<repo_name>/tree/<path:tree_path>')
+@conditional_page()
 def tree(repo_name, tree_path=""):
     ref = request.args.get('ref', 'HEAD')
     refs = get_refs(str(repoRoot / repo_name))
@@ -195,6 +364,7 @@ def tree(repo_name, tree_path=""):
                            tags=refs["tags"])
 
 @app.route('/<repo_name>/blob/<path:blob_path>')
+@conditional_page()
 def blob(repo_name, blob_path):
     ref = request.args.get('ref', 'HEAD')
     blob = get_blob(str(repoRoot / repo_name), blob_path, ref)
@@ -211,11 +381,102 @@ def blob(repo_name, blob_path):
     return render_template("blob.html", 
                            repo_name=repo_name,
                            blob=blob,
+                           server_highlight=SERVER_HIGHLIGHT,
+                           highlighted=highlight_blob(blob),
+                           path_parts=path_parts,
+                           ref=ref,
+                           branches=refs["branches"],
+                           tags=refs["tags"])
+
+@app.route('/<repo_name>/log/<path:file_path>')
+@conditional_page()
+def file_log(repo_name, file_path):
+    ref = request.args.get('ref', 'HEAD')
+    after = request.args.get('after')
+    before = request.args.get('before')
+    
+    # cursors are shas, ignore anything else
+    if after and not SHA_RE.fullmatch(after):
+        after = None
+    if before and not SHA_RE.fullmatch(before):
+        before = None
+    
+    log = get_file_log(str(repoRoot / repo_name), file_path, ref=ref, after=after, before=before)
+    refs = get_refs(str(repoRoot / repo_name))
+    
+    # sent while it renders
+    return stream_template("log.html",
+                           repo_name=repo_name,
+                           file_path=file_path,
+                           commits=log["commits"],
+                           page=log["page"],
+                           has_next=log["has_next"],
+                           has_prev=log["has_prev"],
+                           ref=ref,
+                           branches=refs["branches"],
+                           tags=refs["tags"])
+
+@app.route('/<repo_name>/blame/<path:blob_path>')
+@conditional_page()
+def blame(repo_name, blob_path):
+    ref = request.args.get('ref', 'HEAD')
+    page = max(request.args.get('page', 1, type=int), 1)
+    blame, errors = admission.run("blame", _client(), (repo_name, blob_path, ref, page), run_expensive,
+                                  _with_read_errors, get_blame, str(repoRoot / repo_name), blob_path, ref, page)
+    g.read_errors.extend(errors)
+    refs = get_refs(str(repoRoot / repo_name))
+    
+    path_parts = []
+    parts = blob_path.split('/')
+    current_path = ""
+    for part in parts[:-1]:  # only dirs are linked
+        current_path = f"{current_path}/{part}" if current_path else part
+        path_parts.append({"name": part, "path": current_path})
+    
+    # sent while it renders
+    return stream_template("blame.html",
+                           repo_name=repo_name,
+                           blame=blame,
                            path_parts=path_parts,
                            ref=ref,
                            branches=refs["branches"],
                            tags=refs["tags"])
 
+# stylesheet for server side highlighting, same for every page
+HIGHLIGHT_CSS = highlight_css()
+
+@app.route('/highlight.css')
+def highlight_stylesheet():
+    response = Response(HIGHLIGHT_CSS, mimetype='text/css')
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+# types the browser may render as themselves from the raw endpoint, anything
+# else is sent as plain text so repo content can't run scripts on our origin
+RAW_SAFE_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/x-icon', 'application/pdf')
+
+@app.route('/<repo_name>/raw/<path:blob_path>')
+def raw(repo_name, blob_path):
+    ref = request.args.get('ref', 'HEAD')
+    blob = get_blob_entry(str(repoRoot / repo_name), blob_path, ref)
+    if blob is None:
+        abort(404)
+    
+    mimetype, _ = mimetypes.guess_type(blob['name'])
+    if not (mimetype in RAW_SAFE_TYPES or (mimetype or '').startswith(('audio/', 'video/'))):
+        # werkzeug adds the utf-8 charset to text types
+        mimetype = 'text/plain'
+    
+    response = Response(stream_blob(str(repoRoot / repo_name), blob['hexsha']), mimetype=mimetype)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if is_full_sha(ref) else 'no-cache'
+    response.headers.set('Content-Disposition', 'inline', filename=blob['name'])
+    # content addressed, the blob sha is the perfect etag
+    response.set_etag(blob['hexsha'])
+    # answers If-None-Match with 304 and Range with 206 without reading
+    # more of the blob than needed
+    return response.make_conditional(request, accept_ranges=True, complete_length=blob['size'])
+
 @app.route('/create', methods=['GET', 'POST'])
 @login_required
 def create_repo():
@@ -250,20 +511,36 @@ def search(repo_name):
     ref = request.args.get('ref', 'HEAD')
     refs = get_refs(str(repoRoot / repo_name))
     
+    page = request.args.get('page', 1, type=int)
+    
     results = []
+    truncated = False
+    total = 0
+    has_next = False
     if query:
+        # the same search already running is waited for, not run again
+        key = (repo_name, search_type, query, ref, page)
         if search_type == 'commits':
-            results = search_commits(str(repoRoot / repo_name), query, ref)
+            commit_results = admission.run("search", _client(), key, run_expensive, search_commits, str(repoRoot / repo_name), query, ref, page=max(page, 1))
+            results = commit_results["results"]
+            total = commit_results["total"]
+            has_next = commit_results["has_next"]
         elif search_type == 'files':
-            results = search_files(str(repoRoot / repo_name), query, ref)
+            results = admission.run("search", _client(), key, run_expensive, search_files, str(repoRoot / repo_name), query, ref)
         elif search_type == 'code':
-            results = search_code(str(repoRoot / repo_name), query, ref)
+            code_results = admission.run("search", _client(), key, run_expensive, search_code, str(repoRoot / repo_name), query, ref)
+            results = code_results["results"]
+            truncated = code_results["truncated"]
     
     return render_template('search.html',
                          repo_name=repo_name,
                          query=query,
                          search_type=search_type,
                          results=results,
+                         truncated=truncated,
+                         total=total,
+                         page=page,
+                         has_next=has_next,
                          branches=refs["branches"],
                          tags=refs["tags"],
                          ref=ref)
@@ -271,35 +548,92 @@ def search(repo_name):
 @app.route('/<repo_name>/download')
 def download_repo(repo_name):
     ref = request.args.get('ref', 'HEAD')
+    archive_format = request.args.get('format', 'zip')
     
-    try:
-        # tmp file like /tmp (cleared when reboot)
-        with tempfile.NamedTemporaryFile(suffix='.zip', delete=False) as temp_file:
-            temp_path = temp_file.name
-        
-        repo_path = str(repoRoot / repo_name)
-        # not using tar cause windows
-        cmd = ['git', 'archive', '--format=zip', f'--output={temp_path}', ref]
-        # maybe risky???
-        result = subprocess.run(cmd, cwd=repo_path, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            os.unlink(temp_path)
-            return redirect(url_for('index'))
-        
-        response = send_file(temp_path, 
-                           as_attachment=True, 
-                           download_name=f'{repo_name}-{ref}.zip',
-                           mimetype='application/zip')
-        
-        
-        os.unlink(temp_path)
-        
-        return response
-        
-    except Exception as e:
-        flash(f'error downloading: {str(e)}', 'error')
+    archive = get_archive(str(repoRoot / repo_name), ref, archive_format, _client())
+    if archive is None:
+        flash('error downloading archive', 'error')
         return redirect(url_for('index'))
+    
+    download_name = f"{repo_name}-{ref.replace('/', '-')}.{archive['ext']}"
+    
+    # cached archives are plain files, so they get length and range support
+    if 'path' in archive:
+        return send_file(archive['path'],
+                         as_attachment=True,
+                         download_name=download_name,
+                         mimetype=archive['mimetype'],
+                         conditional=True)
+    
+    # otherwise straight from git archive's stdout as it's produced, which
+    # takes a turn until it's sent
+    release = admission.acquire("download", _client())
+    response = Response(archive['stream'], mimetype=archive['mimetype'])
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.call_on_close(release)
+    return response
+
+# read-only smart http, `git clone https://host/<repo_name>`. pushing and the
+# old dumb protocol aren't served
+def _git_protocol():
+    # passed on to upload-pack, only the version is of interest
+    protocol = request.headers.get('Git-Protocol', '')
+    return protocol if re.fullmatch(r'version=\d', protocol) else None
+
+@app.route('/<repo_name>/info/refs')
+def git_info_refs(repo_name):
+    if request.args.get('service') != 'git-upload-pack':
+        abort(403)
+    refs = get_info_refs(str(repoRoot / repo_name), _git_protocol())
+    if refs is None:
+        abort(404)
+    response = Response(refs, mimetype='application/x-git-upload-pack-advertisement')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/<repo_name>/git-upload-pack', methods=['POST'])
+def git_upload_pack(repo_name):
+    body = request.stream
+    if request.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.GzipFile(fileobj=body)
+    pack = upload_pack(str(repoRoot / repo_name), body, _git_protocol(), _client())
+    if pack is None:
+        abort(404)
+    if 'path' in pack:
+        response = send_file(pack['path'], mimetype='application/x-git-upload-pack-result', conditional=False, etag=False)
+    else:
+        release = admission.acquire("upload-pack", _client())
+        response = Response(pack['stream'], mimetype='application/x-git-upload-pack-result')
+        response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/admin/maintenance')
+@login_required
+def maintenance_page():
+    repos = []
+    for repo in get_repos(repoRoot):
+        try:
+            stats = maintenance.repo_stats(repo['path'])
+        except Exception as e:
+            print(f"error reading repo stats: {e}")
+            continue
+        repos.append({'name': repo['name'], 'stats': stats, 'tasks': maintenance.due_tasks(stats)})
+    return render_template("maintenance.html",
+                           repos=repos,
+                           runs=get_maintenance_runs(),
+                           interval=maintenance.MAINTENANCE_INTERVAL,
+                           budget=maintenance.MAINTENANCE_BUDGET)
+
+@app.route('/admin/maintenance/run', methods=['POST'])
+@login_required
+def run_maintenance_now():
+    if maintenance.MAINTENANCE_INTERVAL:
+        maintenance.run_now()
+        flash('maintenance round started, reload in a while for the results', 'info')
+    else:
+        flash('maintenance is turned off (MAINTENANCE_INTERVAL=0)', 'error')
+    return redirect(url_for('maintenance_page'))
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -324,7 +658,10 @@ def logout():
 # just inject so passing theres no need to pass every time
 @app.context_processor
 def inject_clone_url():
-    return {'ssh_base_url': "git@wisdurm.fi:/srv/git"}
+    # behind a proxy the request's own url is the internal one, set
+    # HTTP_CLONE_BASE_URL to the public address
+    http_base_url = os.getenv('HTTP_CLONE_BASE_URL') or request.url_root.rstrip('/')
+    return {'ssh_base_url': "git@wisdurm.fi:/srv/git", 'http_base_url': http_base_url}
 
 @app.route('/edit_description/<repo_name>', methods=['POST'])
 @login_required
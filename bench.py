@@ -0,0 +1,272 @@
+# benchmarks for util.py and the routes, against generated repos
+#
+#   python bench.py --output report.json
+#   python bench.py --commits 50000 --repos 500 --keep
+#
+# repos are generated into a temp REPO_ROOT (or --root) with git fast-import,
+# then every case is requested through flask's test client. the report has
+# latency percentiles, memory peaks and git calls per request, so runs can be
+# compared over time
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import tracemalloc
+
+WORDS = ["fix", "add", "remove", "refactor", "parser", "cache", "index", "render", "search", "tree",
+         "commit", "blob", "archive", "ref", "branch", "tag", "readme", "config", "worker", "pool",
+         "stream", "diff", "blame", "history", "page", "query", "token", "limit", "error", "update"]
+
+def _data(content):
+    return b"data %d\n%s\n" % (len(content), content)
+
+def _text(rng, lines):
+    return "\n".join(" ".join(rng.choice(WORDS) for _ in range(8)) for _ in range(lines)).encode() + b"\n"
+
+def _tree_paths(width, depth, files_per_dir):
+    # files at every leaf dir of a width x depth tree
+    dirs = [""]
+    for _ in range(depth):
+        dirs = [f"{parent}d{i}/" for parent in dirs for i in range(width)]
+    return [f"{d}f{i}.txt" for d in dirs for i in range(files_per_dir)]
+
+def _fast_import(repo_path, commands):
+    subprocess.run(["git", "init", "--quiet", "--bare", repo_path], check=True)
+    proc = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=repo_path, stdin=subprocess.PIPE)
+    for command in commands:
+        proc.stdin.write(command)
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f"fast-import failed for {repo_path}")
+
+def _big_repo_commands(args, rng):
+    paths = _tree_paths(args.width, args.depth, args.files_per_dir)
+    when = 1_600_000_000
+    author = b"Bench Author <bench@example.com>"
+
+    def commit(mark, message, changes, parent=None, branch=b"refs/heads/master"):
+        out = b"commit %s\nmark :%d\ncommitter %s %d +0000\n" % (branch, mark, author, when + mark * 60)
+        out += _data(message.encode())
+        if parent:
+            out += b"from :%d\n" % parent
+        return out + b"".join(changes) + b"\n"
+
+    # everything in the first commit, wide and deep tree plus the big ones
+    changes = [b"M 100644 inline %s\n%s" % (path.encode(), _data(_text(rng, 20))) for path in paths]
+    changes.append(b"M 100644 inline README.md\n" + _data(b"# bench\n\n" + _text(rng, 50)))
+    for i in range(args.big_blobs):
+        changes.append(b"M 100644 inline big/large%d.txt\n%s" % (i, _data(_text(rng, args.big_blob_size // 64))))
+    for i in range(args.binary_blobs):
+        changes.append(b"M 100644 inline bin/blob%d.bin\n%s" % (i, _data(rng.randbytes(args.big_blob_size))))
+    yield commit(1, "initial import", changes)
+
+    tag_every = max(args.commits // max(args.tags, 1), 1)
+    for mark in range(2, args.commits + 1):
+        changed = rng.sample(paths, min(args.changes_per_commit, len(paths)))
+        changes = [b"M 100644 inline %s\n%s" % (path.encode(), _data(_text(rng, 20))) for path in changed]
+        message = " ".join(rng.choice(WORDS) for _ in range(6)) + f" #{mark}"
+        yield commit(mark, message, changes, parent=mark - 1)
+        if mark % tag_every == 0 and mark // tag_every <= args.tags:
+            number = mark // tag_every
+            if number % 2:
+                yield b"reset refs/tags/v%d\nfrom :%d\n\n" % (number, mark)
+            else:
+                yield b"tag v%d\nfrom :%d\ntagger %s %d +0000\n%s" % (number, mark, author, when + mark * 60, _data(b"release"))
+
+    # a few side branches off the middle of history
+    for i in range(args.branches):
+        yield b"reset refs/heads/branch%d\nfrom :%d\n\n" % (i, rng.randint(1, args.commits))
+
+def _small_repo_commands(rng, commits):
+    author = b"Bench Author <bench@example.com>"
+    for mark in range(1, commits + 1):
+        out = b"commit refs/heads/master\nmark :%d\ncommitter %s %d +0000\n" % (mark, author, 1_600_000_000 + mark * 60)
+        out += _data(f"small change {mark}".encode())
+        if mark > 1:
+            out += b"from :%d\n" % (mark - 1)
+        out += b"M 100644 inline README.md\n" + _data(_text(rng, 5))
+        out += b"M 100644 inline src/main.txt\n" + _data(_text(rng, 30))
+        yield out + b"\n"
+
+def generate(args, root):
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    _fast_import(os.path.join(root, "big.git"), _big_repo_commands(args, rng))
+    subprocess.run(["git", "-C", os.path.join(root, "big.git"), "symbolic-ref", "HEAD", "refs/heads/master"], check=True)
+    for i in range(args.repos):
+        _fast_import(os.path.join(root, f"small{i}.git"), _small_repo_commands(rng, args.small_commits))
+    return time.perf_counter() - start
+
+def _git(root, *command):
+    return subprocess.run(["git", "-C", os.path.join(root, "big.git"), *command],
+                          check=True, capture_output=True, text=True).stdout.strip()
+
+def cases(args, root):
+    deep_dir = "/".join(["d0"] * args.depth)
+    cases = [
+        ("get_repos", "/"),
+        ("overview", "/big.git/"),
+        ("get_commits", "/big.git/commits"),
+    ]
+    for depth in (1000, 10000):
+        if depth < args.commits:
+            cases.append((f"get_commits_depth_{depth}", f"/big.git/commits?after={_git(root, 'rev-list', f'--skip={depth}', '-1', 'HEAD')}"))
+    cases += [
+        ("get_refs", "/big.git/refs"),
+        ("get_tree", "/big.git/tree"),
+        ("get_tree_deep", f"/big.git/tree/{deep_dir}"),
+        ("get_blob", f"/big.git/blob/{deep_dir}/f0.txt"),
+        ("commit", f"/big.git/commit/{_git(root, 'rev-parse', 'HEAD')}"),
+    ]
+    if args.big_blobs:
+        cases.append(("get_blob_large", "/big.git/blob/big/large0.txt"))
+    if args.binary_blobs:
+        cases.append(("get_blob_binary", "/big.git/blob/bin/blob0.bin"))
+    cases += [
+        ("search_commits", "/big.git/search?type=commits&query=parser+cache"),
+        ("search_files", "/big.git/search?type=files&query=f1.txt"),
+        ("search_code", "/big.git/search?type=code&query=refactor+parser"),
+        ("download_zip", "/big.git/download?format=zip"),
+        ("download_tar_gz", "/big.git/download?format=tar.gz"),
+    ]
+    return cases
+
+def _percentile(values, percent):
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(int(round(percent / 100 * len(ordered) + 0.5)) - 1, 0)]
+
+def _git_calls(metrics):
+    processes = 0
+    object_reads = 0
+    for labels, count in metrics.counts("git_command_duration_seconds").items():
+        if dict(labels)["command"].startswith("cat-file --batch"):
+            object_reads += count
+        else:
+            processes += count
+    return processes, object_reads
+
+def run(args, root):
+    # everything reads its config when imported, so only now
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as appmod
+    import metrics
+    client = appmod.app.test_client()
+
+    results = []
+    for name, url in cases(args, root):
+        latencies = []
+        statuses = set()
+        sizes = set()
+        processes_before, reads_before = _git_calls(metrics)
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            response = client.get(url)
+            body = response.get_data()
+            # like a wsgi server would, streamed responses give back their
+            # admission turn on close
+            response.close()
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses.add(response.status_code)
+            sizes.add(len(body))
+        processes_after, reads_after = _git_calls(metrics)
+
+        # one more run for the memory peak, tracemalloc slows everything down
+        tracemalloc.start()
+        response = client.get(url)
+        response.get_data()
+        response.close()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # the first request fills the caches, percentiles are the warm ones
+        warm = latencies[1:] or latencies
+        result = {
+            "name": name,
+            "url": url,
+            "iterations": args.iterations,
+            "status": sorted(statuses),
+            "response_bytes": max(sizes),
+            "cold_ms": round(latencies[0], 3),
+            "p50_ms": round(_percentile(warm, 50), 3),
+            "p90_ms": round(_percentile(warm, 90), 3),
+            "p99_ms": round(_percentile(warm, 99), 3),
+            "max_ms": round(max(warm), 3),
+            "mean_ms": round(sum(warm) / len(warm), 3),
+            "peak_memory_bytes": peak,
+            "git_processes_per_request": round((processes_after - processes_before) / args.iterations, 2),
+            "object_reads_per_request": round((reads_after - reads_before) / args.iterations, 2),
+        }
+        results.append(result)
+        print(f"{name:28} cold {result['cold_ms']:9.1f}ms  p50 {result['p50_ms']:8.1f}ms  p99 {result['p99_ms']:8.1f}ms  "
+              f"git {result['git_processes_per_request']:6.1f}  reads {result['object_reads_per_request']:7.1f}  "
+              f"peak {peak / 1024:8.0f}KB  {result['status']}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark git-webview against generated repos")
+    parser.add_argument("--root", help="generate into (or reuse with --no-generate) this dir instead of a temp one")
+    parser.add_argument("--no-generate", action="store_true", help="use the repos already in --root")
+    parser.add_argument("--keep", action="store_true", help="don't delete the temp root afterwards")
+    parser.add_argument("--output", default="bench-report.json")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--commits", type=int, default=20000)
+    parser.add_argument("--changes-per-commit", type=int, default=3)
+    parser.add_argument("--width", type=int, default=8, help="dirs per level")
+    parser.add_argument("--depth", type=int, default=3, help="dir levels")
+    parser.add_argument("--files-per-dir", type=int, default=8, help="files in every leaf dir")
+    parser.add_argument("--big-blobs", type=int, default=2)
+    parser.add_argument("--binary-blobs", type=int, default=2)
+    parser.add_argument("--big-blob-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--tags", type=int, default=300)
+    parser.add_argument("--branches", type=int, default=10)
+    parser.add_argument("--repos", type=int, default=200, help="small repos next to the big one")
+    parser.add_argument("--small-commits", type=int, default=20)
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="git-webview-bench-")
+    repos = os.path.join(root, "repos")
+    os.makedirs(repos, exist_ok=True)
+    # dbs and caches go with the repos, never next to the app
+    os.environ["REPO_ROOT"] = repos
+    os.environ["DB_PATH"] = os.path.join(root, "bench.db")
+    os.environ["INDEX_DB_PATH"] = os.path.join(root, "bench-index.db")
+
+    try:
+        generation = None
+        if not args.no_generate:
+            print(f"generating repos in {repos}")
+            generation = generate(args, repos)
+            print(f"generated in {generation:.1f}s")
+
+        results = run(args, repos)
+
+        report = {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision": subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       capture_output=True, text=True).stdout.strip() or None,
+            "python": platform.python_version(),
+            "git": subprocess.run(["git", "--version"], capture_output=True, text=True).stdout.strip(),
+            "platform": platform.platform(),
+            "parameters": {key: value for key, value in vars(args).items() if key not in ("root", "output", "keep")},
+            "generation_seconds": generation,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"report written to {args.output}")
+    finally:
+        if not args.root and not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
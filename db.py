@@ -1,61 +1,229 @@
+import os
+import json
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from werkzeug.security import generate_password_hash, check_password_hash
 
-DB_PATH = "git-webview.db"
+# next to the app by default instead of whatever the cwd happens to be
+DB_PATH = os.getenv('DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), "git-webview.db"))
+
+# search indexes can get big, so they live in their own file
+INDEX_DB_PATH = os.getenv('INDEX_DB_PATH', os.path.join(os.path.dirname(DB_PATH), "git-webview-index.db"))
+
+# how long a writer waits for another worker's lock before giving up
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', 5))
+
+# one connection per thread and db file, sqlite connections can't be
+# shared between threads or carried over a fork (gunicorn workers).
+# real threads under gevent too, where threading.local would be per
+# greenlet and every request would connect again. the greenlets of a
+# thread can share a connection, sqlite calls never yield to another
+# greenlet, so nothing runs in the middle of a statement or transaction
+try:
+    from gevent import monkey
+    _local = monkey.get_original('threading', 'local')()
+except ImportError:
+    _local = threading.local()
+# connections inherited from the parent after a fork, never used or closed
+# in the child, closing them could mess with the parent's locks
+_forked = []
+
+def get_db(path=DB_PATH):
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _forked.extend(getattr(_local, 'conns', {}).values())
+        _local.conns = {}
+        _local.pid = pid
+
+    conn = _local.conns.get(path)
+    if conn is None:
+        # statements are prepared once and reused from the per-connection cache
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT, cached_statements=256)
+        # readers don't block the writer (and the other way around) in wal mode
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+        _local.conns[path] = conn
+    return conn
+
+@contextmanager
+def transaction(path=DB_PATH):
+    # commits when the block finishes, rolls back if it raises
+    conn = get_db(path)
+    with conn:
+        yield conn.cursor()
+
+def _json_list(values):
+    # lists are passed as one json parameter and expanded with json_each,
+    # so a batch query is a single prepared statement whatever the size
+    return json.dumps(list(values))
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL
-        )
-    ''')
+    with transaction() as cursor:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL
+            )
+        ''')
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS repos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            repo_name TEXT UNIQUE NOT NULL,
-            owner TEXT NOT NULL
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS repos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                repo_name TEXT UNIQUE NOT NULL,
+                owner TEXT NOT NULL
+            )
+        ''')
+
+        # stats of a commit never change, so computed once per sha
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS commit_stats (
+                hexsha TEXT PRIMARY KEY,
+                files_changed INTEGER NOT NULL,
+                insertions INTEGER NOT NULL,
+                deletions INTEGER NOT NULL
+            )
+        ''')
+
+        # one row per repo maintenance.py worked on, stats are json
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                repo TEXT NOT NULL,
+                started REAL NOT NULL,
+                duration REAL NOT NULL,
+                tasks TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                before TEXT NOT NULL,
+                after TEXT NOT NULL
+            )
+        ''')
+
+        # background jobs only one worker should run at a time
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL,
+                running INTEGER NOT NULL
+            )
+        ''')
+
+    init_index_db()
+
+def init_index_db():
+    with transaction(INDEX_DB_PATH) as cursor:
+        # blobs are content addressed, so one entry serves every repo, ref
+        # and commit that contains the same file
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS code_blobs (
+                id INTEGER PRIMARY KEY,
+                hexsha TEXT UNIQUE NOT NULL
+            )
+        ''')
+
+        # trigram (3 chars packed into an int) -> blobs containing it
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS code_trigrams (
+                trigram INTEGER NOT NULL,
+                blob_id INTEGER NOT NULL,
+                PRIMARY KEY (trigram, blob_id)
+            ) WITHOUT ROWID
+        ''')
+
+        # root trees whose every blob is in code_blobs
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS code_trees (
+                hexsha TEXT PRIMARY KEY
+            )
+        ''')
+
+        # commit metadata per repo, searched through commits_fts
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS commits (
+                id INTEGER PRIMARY KEY,
+                repo TEXT NOT NULL,
+                hexsha TEXT NOT NULL,
+                author TEXT NOT NULL,
+                committer TEXT NOT NULL,
+                date TEXT NOT NULL,
+                message TEXT NOT NULL,
+                UNIQUE (repo, hexsha)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS commits_fts USING fts5 (
+                message, author, committer, hexsha,
+                content='commits', content_rowid='id'
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS commits_fts_insert AFTER INSERT ON commits BEGIN
+                INSERT INTO commits_fts (rowid, message, author, committer, hexsha)
+                VALUES (new.id, new.message, new.author, new.committer, new.hexsha);
+            END
+        ''')
+
+        # tips whose whole history is in commits, new commits are indexed
+        # from these onwards
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS commit_index_tips (
+                repo TEXT NOT NULL,
+                hexsha TEXT NOT NULL,
+                PRIMARY KEY (repo, hexsha)
+            )
+        ''')
+
+        # last commit to touch every path of a branch tip, moved forward with
+        # the branch. tip is what the rows are up to date with
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS last_commit_tips (
+                repo TEXT NOT NULL,
+                ref TEXT NOT NULL,
+                hexsha TEXT NOT NULL,
+                PRIMARY KEY (repo, ref)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS last_commits (
+                repo TEXT NOT NULL,
+                ref TEXT NOT NULL,
+                path TEXT NOT NULL,
+                hexsha TEXT NOT NULL,
+                date INTEGER NOT NULL,
+                subject TEXT NOT NULL,
+                PRIMARY KEY (repo, ref, path)
+            ) WITHOUT ROWID
+        ''')
 
 def create_user(username, password):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
     password_hash = generate_password_hash(password)
-    
+
     try:
-        cursor.execute(
-            'INSERT INTO users (username, password_hash) VALUES (?, ?)',
-            (username, password_hash)
-        )
-        conn.commit()
-        conn.close()
+        with transaction() as cursor:
+            cursor.execute(
+                'INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                (username, password_hash)
+            )
         return True
     except sqlite3.IntegrityError:
-        conn.close()
         return False # ignore
 
 def verify_user(username, password):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute(
+    cursor = get_db().execute(
         'SELECT password_hash FROM users WHERE username = ?',
         (username,)
     )
-    
+
     result = cursor.fetchone()
-    conn.close()
-    
+
     if result:
         return check_password_hash(result[0], password)
     return False
@@ -63,45 +231,267 @@ def verify_user(username, password):
 # REPO QUERIES
 
 def get_repo_info(repo_name):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute(
+    cursor = get_db().execute(
         'SELECT owner FROM repos WHERE repo_name = ?',
         (repo_name,)
     )
-    
+
     result = cursor.fetchone()
-    conn.close()
 
     if result:
         return {"owner": result[0]}
     return False
 
+def get_repos_info(repo_names):
+    # get_repo_info for many repos in one query, repos without an entry are left out
+    if not repo_names:
+        return {}
+
+    cursor = get_db().execute(
+        'SELECT repo_name, owner FROM repos WHERE repo_name IN (SELECT value FROM json_each(?))',
+        (_json_list(repo_names),)
+    )
+
+    return {repo_name: {"owner": owner} for repo_name, owner in cursor.fetchall()}
+
 def set_repo_owner(repo_name, owner):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    with transaction() as cursor:
+        # repo info might not exist yet, so insert or update
+        cursor.execute(
+            'INSERT INTO repos (repo_name, owner) VALUES (?, ?) '
+            'ON CONFLICT (repo_name) DO UPDATE SET owner = excluded.owner',
+            (repo_name, owner)
+        )
+
+def get_all_users():
+    cursor = get_db().execute('SELECT username FROM users')
+    return [row[0] for row in cursor.fetchall()]
+
+# COMMIT STATS
+
+def get_commit_stats(hexshas):
+    if not hexshas:
+        return {}
+
+    cursor = get_db().execute(
+        'SELECT hexsha, files_changed, insertions, deletions FROM commit_stats '
+        'WHERE hexsha IN (SELECT value FROM json_each(?))',
+        (_json_list(hexshas),)
+    )
+
+    stats = {}
+    for hexsha, files_changed, insertions, deletions in cursor.fetchall():
+        stats[hexsha] = {
+            "files_changed": files_changed,
+            "insertions": insertions,
+            "deletions": deletions
+        }
+    return stats
+
+def save_commit_stats(stats):
+    if not stats:
+        return
+
+    with transaction() as cursor:
+        cursor.executemany(
+            'INSERT OR IGNORE INTO commit_stats (hexsha, files_changed, insertions, deletions) VALUES (?, ?, ?, ?)',
+            [(hexsha, s["files_changed"], s["insertions"], s["deletions"]) for hexsha, s in stats.items()]
+        )
+
+# CODE SEARCH INDEX
+
+def is_code_tree_indexed(tree_hexsha):
+    cursor = get_db(INDEX_DB_PATH).execute('SELECT 1 FROM code_trees WHERE hexsha = ?', (tree_hexsha,))
+    return cursor.fetchone() is not None
+
+def mark_code_tree_indexed(tree_hexsha):
+    with transaction(INDEX_DB_PATH) as cursor:
+        cursor.execute('INSERT OR IGNORE INTO code_trees (hexsha) VALUES (?)', (tree_hexsha,))
 
-    # repo info might not exist yet, so check, if not, insert
-    cursor.execute('SELECT id FROM repos WHERE repo_name = ?', (repo_name,))
+def get_indexed_code_blobs(hexshas):
+    if not hexshas:
+        return set()
+
+    cursor = get_db(INDEX_DB_PATH).execute(
+        'SELECT hexsha FROM code_blobs WHERE hexsha IN (SELECT value FROM json_each(?))',
+        (_json_list(hexshas),)
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+def add_code_blobs(blobs):
+    # blobs is a list of (hexsha, trigrams)
+    with transaction(INDEX_DB_PATH) as cursor:
+        for hexsha, trigrams in blobs:
+            cursor.execute('INSERT OR IGNORE INTO code_blobs (hexsha) VALUES (?)', (hexsha,))
+            # another worker got there first
+            if cursor.rowcount == 0:
+                continue
+            blob_id = cursor.lastrowid
+            cursor.executemany(
+                'INSERT OR IGNORE INTO code_trigrams (trigram, blob_id) VALUES (?, ?)',
+                [(trigram, blob_id) for trigram in trigrams]
+            )
+
+def find_code_blobs(trigrams):
+    # blobs that contain every one of the trigrams
+    if not trigrams:
+        return set()
+
+    intersect = ' INTERSECT '.join(['SELECT blob_id FROM code_trigrams WHERE trigram = ?'] * len(trigrams))
+    cursor = get_db(INDEX_DB_PATH).execute(
+        f'SELECT hexsha FROM code_blobs WHERE id IN ({intersect})',
+        list(trigrams)
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+# COMMIT SEARCH INDEX
+
+def get_commit_index_tips(repo):
+    cursor = get_db(INDEX_DB_PATH).execute('SELECT hexsha FROM commit_index_tips WHERE repo = ?', (repo,))
+    return [row[0] for row in cursor.fetchall()]
+
+def set_commit_index_tips(repo, hexshas):
+    with transaction(INDEX_DB_PATH) as cursor:
+        cursor.execute('DELETE FROM commit_index_tips WHERE repo = ?', (repo,))
+        cursor.executemany(
+            'INSERT INTO commit_index_tips (repo, hexsha) VALUES (?, ?)',
+            [(repo, hexsha) for hexsha in hexshas]
+        )
+
+def add_commits(repo, commits):
+    with transaction(INDEX_DB_PATH) as cursor:
+        cursor.executemany(
+            'INSERT OR IGNORE INTO commits (repo, hexsha, author, committer, date, message) VALUES (?, ?, ?, ?, ?, ?)',
+            [(repo, c["hexsha"], c["author"], c["committer"], c["date"], c["message"]) for c in commits]
+        )
+
+def search_indexed_commits(repo, match):
+    # best matches first, lazily so callers can stop early
+    return get_db(INDEX_DB_PATH).execute(
+        'SELECT c.hexsha, c.author, c.date, c.message FROM commits_fts '
+        'JOIN commits c ON c.id = commits_fts.rowid '
+        'WHERE commits_fts MATCH ? AND c.repo = ? ORDER BY commits_fts.rank',
+        (match, repo)
+    )
+
+# LAST COMMIT INDEX
+
+def get_last_commit_tip(repo, ref):
+    cursor = get_db(INDEX_DB_PATH).execute(
+        'SELECT hexsha FROM last_commit_tips WHERE repo = ? AND ref = ?',
+        (repo, ref)
+    )
     result = cursor.fetchone()
-    if result:
-        cursor.execute('UPDATE repos SET owner = ? WHERE repo_name = ?', (owner, repo_name))
-    else:
-        cursor.execute('INSERT INTO repos (repo_name, owner) VALUES (?, ?)', (repo_name, owner))
-    conn.commit()
-    conn.close()
+    return result[0] if result else None
 
-def get_all_users():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT username FROM users')
-    users = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return users
+def save_last_commits(repo, ref, old_tip, new_tip, entries, replace=False):
+    # entries is a dict of path -> (hexsha, date, subject). only applied if
+    # nobody moved the tip since old_tip was read, returns whether it was
+    with transaction(INDEX_DB_PATH) as cursor:
+        # take the write lock before reading the tip so the check holds
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT hexsha FROM last_commit_tips WHERE repo = ? AND ref = ?', (repo, ref))
+        result = cursor.fetchone()
+        if (result[0] if result else None) != old_tip:
+            return False
+
+        if replace:
+            cursor.execute('DELETE FROM last_commits WHERE repo = ? AND ref = ?', (repo, ref))
+        cursor.executemany(
+            'INSERT OR REPLACE INTO last_commits (repo, ref, path, hexsha, date, subject) VALUES (?, ?, ?, ?, ?, ?)',
+            [(repo, ref, path, hexsha, date, subject) for path, (hexsha, date, subject) in entries.items()]
+        )
+        cursor.execute(
+            'INSERT OR REPLACE INTO last_commit_tips (repo, ref, hexsha) VALUES (?, ?, ?)',
+            (repo, ref, new_tip)
+        )
+    return True
+
+def get_last_commits(repo, ref, paths):
+    if not paths:
+        return {}
+
+    cursor = get_db(INDEX_DB_PATH).execute(
+        'SELECT path, hexsha, date, subject FROM last_commits '
+        'WHERE repo = ? AND ref = ? AND path IN (SELECT value FROM json_each(?))',
+        (repo, ref, _json_list(paths))
+    )
+    return {path: (hexsha, date, subject) for path, hexsha, date, subject in cursor.fetchall()}
+
+def prune_last_commit_refs(repo, refs):
+    # drop the index of branches that no longer exist
+    with transaction(INDEX_DB_PATH) as cursor:
+        cursor.execute(
+            'DELETE FROM last_commits WHERE repo = ? AND ref NOT IN (SELECT value FROM json_each(?))',
+            (repo, _json_list(refs))
+        )
+        cursor.execute(
+            'DELETE FROM last_commit_tips WHERE repo = ? AND ref NOT IN (SELECT value FROM json_each(?))',
+            (repo, _json_list(refs))
+        )
+
+# MAINTENANCE
+
+# how many maintenance runs are kept for the admin page
+MAINTENANCE_RUNS_KEPT = 1000
+
+def add_maintenance_run(repo, started, duration, tasks, status, error, before, after):
+    with transaction() as cursor:
+        cursor.execute(
+            'INSERT INTO maintenance_runs (repo, started, duration, tasks, status, error, before, after) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (repo, started, duration, json.dumps(tasks), status, error, json.dumps(before), json.dumps(after))
+        )
+        cursor.execute(
+            'DELETE FROM maintenance_runs WHERE id <= (SELECT MAX(id) FROM maintenance_runs) - ?',
+            (MAINTENANCE_RUNS_KEPT,)
+        )
+
+def get_maintenance_runs(limit=100):
+    cursor = get_db().execute(
+        'SELECT repo, started, duration, tasks, status, error, before, after FROM maintenance_runs '
+        'ORDER BY id DESC LIMIT ?',
+        (limit,)
+    )
+    return [{
+        "repo": repo,
+        "started": started,
+        "duration": duration,
+        "tasks": json.loads(tasks),
+        "status": status,
+        "error": error,
+        "before": json.loads(before),
+        "after": json.loads(after)
+    } for repo, started, duration, tasks, status, error, before, after in cursor.fetchall()]
+
+# LEASES
+
+def acquire_lease(name, owner, seconds, force=False):
+    # free once expired. force takes it before that too, unless the job is
+    # running right now
+    now = time.time()
+    with transaction() as cursor:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT expires, running FROM leases WHERE name = ?', (name,))
+        result = cursor.fetchone()
+        if result and result[0] > now and (result[1] or not force):
+            return False
+        cursor.execute(
+            'INSERT OR REPLACE INTO leases (name, owner, expires, running) VALUES (?, ?, ?, 1)',
+            (name, owner, now + seconds)
+        )
+    return True
+
+def finish_lease(name, owner, seconds):
+    # the job is done but nobody starts it again for seconds
+    with transaction() as cursor:
+        cursor.execute(
+            'UPDATE leases SET expires = ?, running = 0 WHERE name = ? AND owner = ?',
+            (time.time() + seconds, name, owner)
+        )
 
 if __name__ == "__main__":
     init_db()
 
     create_user("admin", "admin") # for now
-    create_user("Luka Hietala", "admin")
\ No newline at end of file
+    create_user("Luka Hietala", "admin")
@@ -0,0 +1,26 @@
+# picked up by gunicorn from the working dir, see SETUP.md
+import multiprocessing
+import os
+
+# threads by default, a slow request only holds its own thread and the
+# expensive ones (searches, blame, highlighting) run on real threads next
+# to the others. GUNICORN_WORKER_CLASS=gevent serves many more requests
+# per worker, waiting on git yields to the others, but everything runs on
+# the one thread: cpu bound work (highlighting a big blob, indexing code
+# for search) stalls every request of the worker until it's done. git
+# can't be started from real threads under gevent, so that's not avoidable
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# concurrent requests per worker, gevent and gthread respectively
+worker_connections = int(os.getenv('GUNICORN_CONNECTIONS', 1000))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# archive downloads and big blobs are streamed, the timeout is for a
+# worker that stopped responding, not for a long response
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+
+# gevent has to patch before the app (and its locks and executors) is
+# imported, so the app is loaded in every worker
+preload_app = False
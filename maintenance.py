@@ -0,0 +1,218 @@
+import os
+import time
+import shutil
+import socket
+import threading
+import subprocess
+from pathlib import Path
+import db
+import metrics
+
+# seconds between maintenance rounds, 0 turns them off
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', 3600))
+# seconds of git time one round may use, the command running when it's
+# used up is stopped and the rest waits for the next round
+MAINTENANCE_BUDGET = float(os.getenv('MAINTENANCE_BUDGET', 600))
+# niceness of the maintenance commands, they also get the lowest best
+# effort io priority when ionice is there
+MAINTENANCE_NICE = int(os.getenv('MAINTENANCE_NICE', 10))
+# repack once a repo has this many loose objects or this many packs
+MAINTENANCE_LOOSE_OBJECTS = int(os.getenv('MAINTENANCE_LOOSE_OBJECTS', 1000))
+MAINTENANCE_MAX_PACKS = int(os.getenv('MAINTENANCE_MAX_PACKS', 10))
+# pack refs once this many are loose files (hundreds of tags after a while)
+MAINTENANCE_LOOSE_REFS = int(os.getenv('MAINTENANCE_LOOSE_REFS', 100))
+
+# task -> git arguments, run in this order
+MAINTENANCE_TASKS = {
+    # packs loose objects and rolls small packs into bigger ones so pack
+    # sizes stay a geometric progression, with a multi-pack index and a
+    # reachability bitmap over all of them (counting objects for clones)
+    "repack": ["repack", "-d", "--geometric=2", "--write-midx", "--write-bitmap-index", "--quiet"],
+    # commit walks without parsing commits, and bloom filters for the path
+    # limited ones (history, last commits). split so a write only adds a layer
+    "commit-graph": ["commit-graph", "write", "--reachable", "--changed-paths", "--split", "--no-progress"],
+    "pack-refs": ["pack-refs", "--all", "--prune"],
+}
+
+_LEASE = "maintenance"
+
+_scheduler = None
+# set to start a round now instead of at the end of the interval
+_run_now = threading.Event()
+
+def _priority():
+    command = []
+    if shutil.which("ionice"):
+        command += ["ionice", "-c", "2", "-n", "7"]
+    if shutil.which("nice"):
+        command += ["nice", "-n", str(MAINTENANCE_NICE)]
+    return command
+
+def _run_git(git_dir, args, timeout):
+    with metrics.timed("git_command_duration_seconds", command=args[0], operation="maintenance"):
+        result = subprocess.run([*_priority(), "git", "-C", str(git_dir), *args],
+                                capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"git {args[0]} exited with {result.returncode}: {result.stderr.strip()}")
+    return result.stdout
+
+def _commit_graph_file(git_dir):
+    info = Path(git_dir) / "objects" / "info"
+    for path in (info / "commit-graphs" / "commit-graph-chain", info / "commit-graph"):
+        if path.exists():
+            return path
+    return None
+
+def is_bare_repo(path):
+    path = Path(path)
+    return (path / "HEAD").is_file() and (path / "objects").is_dir() and (path / "refs").is_dir()
+
+def repo_stats(git_dir):
+    git_dir = Path(git_dir)
+    counts = {}
+    for line in _run_git(git_dir, ["count-objects", "-v"], None).splitlines():
+        key, _, value = line.partition(": ")
+        counts[key] = int(value)
+
+    # refs written since the graph was means commits it doesn't have
+    refs_mtime = 0
+    loose_refs = 0
+    packed_refs = git_dir / "packed-refs"
+    if packed_refs.exists():
+        refs_mtime = packed_refs.stat().st_mtime
+    for dirpath, _, filenames in os.walk(git_dir / "refs"):
+        refs_mtime = max(refs_mtime, os.stat(dirpath).st_mtime)
+        loose_refs += len(filenames)
+
+    graph = _commit_graph_file(git_dir)
+    if graph is None:
+        commit_graph = "missing"
+    elif graph.stat().st_mtime < refs_mtime:
+        commit_graph = "stale"
+    else:
+        commit_graph = "fresh"
+
+    pack_dir = git_dir / "objects" / "pack"
+    bitmap = pack_dir.is_dir() and any(name.endswith(".bitmap") for name in os.listdir(pack_dir))
+
+    return {
+        "loose_objects": counts.get("count", 0),
+        "loose_kb": counts.get("size", 0),
+        "packed_objects": counts.get("in-pack", 0),
+        "packs": counts.get("packs", 0),
+        "pack_kb": counts.get("size-pack", 0),
+        "garbage": counts.get("garbage", 0),
+        "loose_refs": loose_refs,
+        "has_refs": loose_refs > 0 or packed_refs.exists(),
+        "commit_graph": commit_graph,
+        "bitmap": bitmap,
+    }
+
+def due_tasks(stats):
+    # empty repos have nothing to maintain
+    if not stats["has_refs"]:
+        return []
+    tasks = []
+    if (stats["loose_objects"] >= MAINTENANCE_LOOSE_OBJECTS or stats["packs"] > MAINTENANCE_MAX_PACKS
+            or not stats["bitmap"]):
+        tasks.append("repack")
+    if stats["commit_graph"] != "fresh":
+        tasks.append("commit-graph")
+    if stats["loose_refs"] >= MAINTENANCE_LOOSE_REFS:
+        tasks.append("pack-refs")
+    return tasks
+
+def _maintain(git_dir, tasks, before, deadline):
+    started = time.time()
+    done = []
+    status = "ok"
+    error = None
+    for task in tasks:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            status = "budget"
+            break
+        try:
+            _run_git(git_dir, MAINTENANCE_TASKS[task], remaining)
+        except subprocess.TimeoutExpired:
+            status = "budget"
+            break
+        except Exception as e:
+            status = "error"
+            error = str(e)
+            break
+        done.append(task)
+        if task == "commit-graph":
+            # git leaves the graph alone when no commits were added (only
+            # deleted refs), it's up to date all the same
+            graph = _commit_graph_file(git_dir)
+            if graph is not None:
+                os.utime(graph)
+
+    try:
+        after = repo_stats(git_dir)
+    except Exception as e:
+        print(f"error reading repo stats: {e}")
+        after = before
+    db.add_maintenance_run(git_dir.name, started, time.time() - started, done, status, error, before, after)
+    return status
+
+def run_maintenance(repos_path):
+    # one round, a repo at a time, the ones worst off first, until the
+    # budget runs out
+    deadline = time.monotonic() + MAINTENANCE_BUDGET
+    candidates = []
+    for entry in sorted(os.scandir(repos_path), key=lambda entry: entry.name):
+        git_dir = Path(entry.path)
+        if not entry.is_dir() or not is_bare_repo(git_dir):
+            continue
+        try:
+            stats = repo_stats(git_dir)
+        except Exception as e:
+            print(f"error reading repo stats: {e}")
+            continue
+        tasks = due_tasks(stats)
+        if tasks:
+            candidates.append((stats, git_dir, tasks))
+
+    candidates.sort(key=lambda candidate: (-candidate[0]["loose_objects"], -candidate[0]["packs"]))
+    for stats, git_dir, tasks in candidates:
+        if deadline <= time.monotonic():
+            break
+        _maintain(git_dir, tasks, stats, deadline)
+
+def run_now():
+    _run_now.set()
+
+def start_maintenance(repos_path):
+    # every worker runs this, the lease makes sure only one of them does a
+    # round per interval
+    global _scheduler
+    if _scheduler is not None or not MAINTENANCE_INTERVAL:
+        return
+
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def work():
+        while True:
+            forced = _run_now.wait(MAINTENANCE_INTERVAL)
+            _run_now.clear()
+            try:
+                # generous, a round that outlives it is assumed dead
+                if not db.acquire_lease(_LEASE, owner, MAINTENANCE_BUDGET * 2 + 60, force=forced):
+                    continue
+            except Exception as e:
+                print(f"error taking maintenance lease: {e}")
+                continue
+            started = time.time()
+            try:
+                run_maintenance(repos_path)
+            except Exception as e:
+                print(f"error running maintenance: {e}")
+            finally:
+                # held until a bit before the next round is due, counted
+                # from this one's start so the workers' timers still match
+                db.finish_lease(_LEASE, owner, max(started + MAINTENANCE_INTERVAL * 0.9 - time.time(), 0))
+
+    _scheduler = threading.Thread(target=work, name="maintenance", daemon=True)
+    _scheduler.start()
@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+
+# log requests slower than this many ms, off when unset
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 0))
+
+# seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name -> (type, help), every metric has to be described here
+METRICS = {
+    "http_request_duration_seconds": ("histogram", "Time to produce a response, by route."),
+    "template_render_duration_seconds": ("histogram", "Time spent rendering templates."),
+    "operation_duration_seconds": ("histogram", "Time spent in util.py functions."),
+    "git_command_duration_seconds": ("histogram", "Git subprocesses and object reads, by the util.py function that made them."),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result (hit or miss)."),
+    "bytes_streamed_total": ("counter", "Bytes read from streamed git commands (archives, raw blobs), by command."),
+    "admission_wait_duration_seconds": ("histogram", "Time expensive requests waited for a turn, by endpoint."),
+    "admission_rejected_total": ("counter", "Expensive requests answered with 503, by endpoint and reason (client, queue, timeout)."),
+    "coalesced_requests_total": ("counter", "Requests that shared the work of an identical one already running, by kind."),
+}
+
+# per process, every gunicorn worker keeps (and reports) its own numbers
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+
+# the util.py function currently running, git calls are counted under it
+_operation = contextvars.ContextVar('operation', default='none')
+# per request: operation -> total seconds, for the slow request log
+_request_operations = contextvars.ContextVar('request_operations', default=None)
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+def cache_hit(cache):
+    inc("cache_requests_total", cache=cache, result="hit")
+
+def cache_miss(cache):
+    inc("cache_requests_total", cache=cache, result="miss")
+
+def current_operation():
+    return _operation.get()
+
+def operation(f):
+    # times a util.py function and labels the git calls it makes with its name
+    name = f.__name__
+
+    @wraps(f)
+    def timed(*args, **kwargs):
+        token = _operation.set(name)
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _operation.reset(token)
+            observe("operation_duration_seconds", elapsed, operation=name)
+            totals = _request_operations.get()
+            if totals is not None:
+                totals[name] = totals.get(name, 0.0) + elapsed
+    return timed
+
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def start_request():
+    # returns what finish_request needs
+    return _request_operations.set({}), time.perf_counter()
+
+def finish_request(state, route, method, status, description):
+    token, start = state
+    elapsed = time.perf_counter() - start
+    totals = _request_operations.get() or {}
+    _request_operations.reset(token)
+    observe("http_request_duration_seconds", elapsed, route=route, method=method, status=str(status))
+
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        operations = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in
+                               sorted(totals.items(), key=lambda item: -item[1]))
+        print(f"slow request: {elapsed * 1000:.0f}ms {description} [{operations}]")
+
+def counts(name):
+    # observations of a histogram so far, labels -> count
+    with _lock:
+        return {labels: histogram["count"] for (metric, labels), histogram in _histograms.items() if metric == name}
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def render():
+    # prometheus text format
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                      for key, h in _histograms.items()}
+
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        else:
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                # buckets are already cumulative, each observation counts in
+                # every bucket it fits
+                for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
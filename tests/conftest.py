@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# db paths and the repo root are read on import, so they're set before any test
+# module imports db or app
+_root = tempfile.mkdtemp(prefix="git-webview-tests-")
+os.environ.setdefault("DB_PATH", os.path.join(_root, "test.db"))
+os.environ.setdefault("INDEX_DB_PATH", os.path.join(_root, "test-index.db"))
+os.environ.setdefault("REPO_ROOT", os.path.join(_root, "repos"))
+os.makedirs(os.environ["REPO_ROOT"], exist_ok=True)
+os.environ.setdefault("MAINTENANCE_INTERVAL", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,58 @@
+import subprocess
+import pytest
+import db
+import util
+
+def _git(cwd, *args):
+    return subprocess.run(["git", "-c", "user.name=Test", "-c", "user.email=test@example.com", *args],
+                          cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+def _commit(work, message):
+    with open(work / "file.txt", "a") as f:
+        f.write(message + "\n")
+    _git(work, "add", "file.txt")
+    _git(work, "commit", "-q", "-m", message)
+    return _git(work, "rev-parse", "HEAD")
+
+@pytest.fixture
+def packed_repo(tmp_path):
+    # two branches that went apart, everything packed so no object is loose
+    work = tmp_path / "work"
+    work.mkdir()
+    _git(work, "init", "-q", "-b", "master")
+    _commit(work, "first")
+    _git(work, "branch", "feature")
+    master = _commit(work, "on master")
+    _git(work, "checkout", "-q", "feature")
+    feature = _commit(work, "on feature")
+    bare = tmp_path / "repo.git"
+    _git(tmp_path, "clone", "-q", "--bare", str(work), str(bare))
+    _git(bare, "repack", "-a", "-d", "-q")
+    _git(bare, "prune-packed")
+    db.init_db()
+    return work, bare, master, feature
+
+def test_tips_survive_packed_objects(packed_repo, monkeypatch):
+    work, bare, master, feature = packed_repo
+    repo = util.get_repo(str(bare))
+
+    util._index_commits(repo, master)
+    util._index_commits(repo, feature)
+    assert set(db.get_commit_index_tips(repo.git_dir)) == {master, feature}
+
+    # indexing master again walks nothing, feature's tip didn't push it out
+    walked = []
+    monkeypatch.setattr(db, "add_commits", lambda git_dir, commits: walked.extend(commits))
+    util._index_commits(repo, master)
+    assert walked == []
+
+    # a new commit on top of feature only walks that one commit
+    _git(work, "push", "-q", str(bare), "feature")
+    newer = _commit(work, "more on feature")
+    _git(work, "push", "-q", str(bare), "feature")
+    _git(bare, "repack", "-a", "-d", "-q")
+    util.invalidate_repo(str(bare))
+    repo = util.get_repo(str(bare))
+    util._index_commits(repo, newer)
+    assert [commit["hexsha"] for commit in walked] == [newer]
+    assert set(db.get_commit_index_tips(repo.git_dir)) == {master, newer}
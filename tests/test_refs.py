@@ -0,0 +1,16 @@
+import subprocess
+import util
+
+def test_refs_same_shape_on_every_path(tmp_path):
+    work = tmp_path / "work"
+    subprocess.run(["git", "init", "-q", "-b", "master", str(work)], check=True)
+    subprocess.run(["git", "-c", "user.name=Test", "-c", "user.email=test@example.com", "commit", "-q",
+                    "--allow-empty", "-m", "first"], cwd=work, check=True)
+    bare = tmp_path / "repo.git"
+    subprocess.run(["git", "clone", "-q", "--bare", str(work), str(bare)], check=True)
+
+    snapshot = util.get_refs(str(bare))
+    assert snapshot["head_branch"] == "master"
+    # not bare, and not a repo at all
+    for path in (work, tmp_path / "missing.git"):
+        assert util.get_refs(str(path)).keys() == snapshot.keys()
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import pytest
+import app as appmod
+
+def _git(cwd, *args):
+    return subprocess.run(["git", "-c", "user.name=Test", "-c", "user.email=test@example.com", *args],
+                          cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    work = tmp_path_factory.mktemp("work")
+    _git(work, "init", "-q", "-b", "master")
+    for message in ("first", "second"):
+        with open(work / "a.txt", "a") as f:
+            f.write(message + "\n")
+        _git(work, "add", "a.txt")
+        _git(work, "commit", "-q", "-m", message)
+    _git(work, "clone", "-q", "--bare", str(work), os.path.join(os.environ["REPO_ROOT"], "r.git"))
+    return appmod.app.test_client()
+
+@pytest.mark.parametrize("url", [
+    # refs that aren't a branch, a tag or a full sha skip the etag
+    "/r.git/blame/a.txt?ref=HEAD~1",
+    "/r.git/blame/a.txt?ref=nosuch",
+    "/nosuchrepo/blame/a.txt",
+])
+def test_blame_without_etag(client, url):
+    response = client.get(url)
+    response.get_data()
+    assert response.status_code < 500
+    assert "ETag" not in response.headers
+
+def test_blame_older_commit(client):
+    response = client.get("/r.git/blame/a.txt?ref=HEAD~1")
+    assert b"first" in response.get_data()
+    assert b"second" not in response.get_data()
+
+def test_raw_content_type(client):
+    response = client.get("/r.git/raw/a.txt")
+    response.get_data()
+    response.close()
+    assert response.headers["Content-Type"] == "text/plain; charset=utf-8"
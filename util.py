@@ -1,6 +1,327 @@
 from pathlib import Path
+from datetime import datetime
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import re
+import shlex
+import hashlib
+import itertools
+import subprocess
+import tempfile
+import threading
+import time
+import contextvars
 import git
+import markdown
+import nh3
+import db
+import metrics
+import admission
 
+try:
+    import pygments
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_for_filename
+    from pygments.util import ClassNotFound
+except ImportError:
+    # optional, without it blobs are only highlighted in the browser
+    pygments = None
+
+def _git_subcommand(command):
+    # "log" out of ["git", "-c", "x=y", "log", ...]
+    args = iter(command[1:])
+    for arg in args:
+        if arg == "-c":
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg
+    return "git"
+
+class InstrumentedGit(git.Git):
+    # every git subprocess and object read is timed, labeled with the
+    # util.py function that made it
+    def execute(self, command, *args, **kwargs):
+        labels = {"command": _git_subcommand(command), "operation": metrics.current_operation()}
+        start = time.perf_counter()
+        if not kwargs.get("as_process"):
+            with metrics.timed("git_command_duration_seconds", **labels):
+                return super().execute(command, *args, **kwargs)
+
+        # still running when it's handed back, timed until it's waited for
+        result = super().execute(command, *args, **kwargs)
+        proc = result.proc
+        wait = proc.wait
+        def timed_wait(*wait_args, **wait_kwargs):
+            status = wait(*wait_args, **wait_kwargs)
+            if proc.wait is timed_wait:
+                proc.wait = wait
+                metrics.observe("git_command_duration_seconds", time.perf_counter() - start, **labels)
+            return status
+        proc.wait = timed_wait
+        return result
+
+    def get_object_header(self, ref):
+        with metrics.timed("git_command_duration_seconds", command="cat-file --batch-check",
+                           operation=metrics.current_operation()):
+            return super().get_object_header(ref)
+
+    def stream_object_data(self, ref):
+        with metrics.timed("git_command_duration_seconds", command="cat-file --batch",
+                           operation=metrics.current_operation()):
+            return super().stream_object_data(ref)
+
+git.Repo.GitCommandWrapperType = InstrumentedGit
+
+# max open repo handles per worker, every handle keeps up to two
+# persistent `git cat-file` helpers alive (--batch and --batch-check),
+# so this also caps the helper processes at 2x this number. more are only
+# open while more than this many are in use at the same moment
+REPO_POOL_SIZE = int(os.getenv('REPO_POOL_SIZE', 16))
+
+# handles nobody is using, least recently used first: id(repo) -> (abs
+# path, dir identity, repo). a handle in use is leased to one scope (a
+# request, a background job) and is only ever closed once it's back here,
+# a cat-file helper can't be shared mid-read
+_idle_repos = OrderedDict()
+# idle and leased
+_open_repos = 0
+_repo_pool_lock = threading.Lock()
+
+# the current scope's leases: abs path -> (dir identity, repo), plus the
+# handles it stopped using (repo recreated under the same name) under None
+_repo_scope = contextvars.ContextVar('repo_scope', default=None)
+
+def _close_repo(repo):
+    try:
+        # kills the cat-file helpers
+        repo.close()
+    except Exception as e:
+        print(f"error closing repo: {e}")
+
+def _trim_idle_repos():
+    # call with the lock held, returns what to close after letting go of it
+    global _open_repos
+    evicted = []
+    while _open_repos > REPO_POOL_SIZE and _idle_repos:
+        _, (_, _, repo) = _idle_repos.popitem(last=False)
+        _open_repos -= 1
+        evicted.append(repo)
+    return evicted
+
+def open_repo_scope():
+    # repos from get_repo are leased to this scope until close_repo_scope.
+    # threads running with a copy of the context (run_expensive) share it
+    scope = {}
+    _repo_scope.set(scope)
+    return scope
+
+def close_repo_scope(scope):
+    global _open_repos
+    if _repo_scope.get() is scope:
+        _repo_scope.set(None)
+    leases = list(scope.pop(None, []))
+    leases += [(path, identity, repo) for path, (identity, repo) in scope.items()]
+    scope.clear()
+    with _repo_pool_lock:
+        for path, identity, repo in leases:
+            _idle_repos[id(repo)] = (path, identity, repo)
+        evicted = _trim_idle_repos()
+    for repo in evicted:
+        _close_repo(repo)
+
+@contextmanager
+def repo_scope():
+    # for work outside a request, nested scopes use the outer one
+    if _repo_scope.get() is not None:
+        yield
+        return
+    scope = open_repo_scope()
+    try:
+        yield
+    finally:
+        close_repo_scope(scope)
+
+def get_repo(repo_path):
+    global _open_repos
+    path = os.path.abspath(repo_path)
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        # dir went away, drop whatever we had open for it
+        invalidate_repo(path)
+        raise git.NoSuchPathError(path)
+
+    # repo deleted and recreated under the same name gets a new inode
+    identity = (stat.st_dev, stat.st_ino)
+
+    scope = _repo_scope.get()
+    if scope is None:
+        # nothing would give a lease back, so a handle of its own that is
+        # closed when it's garbage collected
+        metrics.cache_miss("repo_pool")
+        return git.Repo(path)
+
+    leased = scope.get(path)
+    if leased is not None:
+        if leased[0] == identity:
+            return leased[1]
+        # the old handle goes back with the rest when the scope ends
+        scope.setdefault(None, []).append((path, *scope.pop(path)))
+
+    stale = []
+    repo = None
+    with _repo_pool_lock:
+        # most recently used idle handle of this repo
+        for key in reversed(list(_idle_repos)):
+            if _idle_repos[key][0] != path:
+                continue
+            _, idle_identity, idle_repo = _idle_repos.pop(key)
+            if idle_identity == identity:
+                repo = idle_repo
+                break
+            _open_repos -= 1
+            stale.append(idle_repo)
+        if repo is None:
+            # counted before it exists so the cap holds for concurrent misses
+            _open_repos += 1
+            stale += _trim_idle_repos()
+
+    for old in stale:
+        _close_repo(old)
+
+    if repo is not None:
+        metrics.cache_hit("repo_pool")
+    else:
+        metrics.cache_miss("repo_pool")
+        try:
+            repo = git.Repo(path)
+        except Exception:
+            with _repo_pool_lock:
+                _open_repos -= 1
+            raise
+
+    scope[path] = (identity, repo)
+    return repo
+
+def invalidate_repo(repo_path):
+    # idle handles are closed now, leased ones when they come back and
+    # don't match the dir anymore
+    global _open_repos
+    path = os.path.abspath(repo_path)
+    with _repo_pool_lock:
+        keys = [key for key, entry in _idle_repos.items() if entry[0] == path]
+        dropped = [_idle_repos.pop(key)[2] for key in keys]
+        _open_repos -= len(dropped)
+    for repo in dropped:
+        _close_repo(repo)
+
+# searches and blame run on this pool, so only this many of them hold git
+# processes and cpu at once however many requests are waiting on them.
+# separate from the search pool, a search running here submits to that one
+EXPENSIVE_WORKERS = int(os.getenv('EXPENSIVE_WORKERS', 4))
+
+_expensive_executor = ThreadPoolExecutor(max_workers=EXPENSIVE_WORKERS, thread_name_prefix="expensive")
+
+def run_expensive(fn, *args, **kwargs):
+    # the calling request waits without holding anything but its own
+    # thread (or greenlet under gevent)
+    # the context goes along so git calls are still counted for the request
+    return _expensive_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs).result()
+
+# reads that failed and were answered with an empty result instead (or
+# only a part of what a later read will give), so a page built from them
+# isn't cached like a real one
+_read_errors = contextvars.ContextVar('read_errors', default=None)
+
+@contextmanager
+def track_read_errors():
+    # yields the list of what failed in this block, threads running with a
+    # copy of the context (run_expensive) included
+    errors = []
+    token = _read_errors.set(errors)
+    try:
+        yield errors
+    finally:
+        _read_errors.reset(token)
+
+def _read_partial(message):
+    errors = _read_errors.get()
+    if errors is not None:
+        errors.append(message)
+
+def _read_failed(message, e):
+    print(f"{message}: {e}")
+    _read_partial(message)
+
+# repo root identity -> dir names, so the root is only listed after a
+# repo was added or removed (that changes the root dir's mtime)
+_repo_listing = None
+# repo dir -> (state, info or None for dirs that aren't bare repos)
+_repo_catalogue = {}
+_repo_catalogue_lock = threading.Lock()
+
+def _repo_dirs(repos_path):
+    global _repo_listing
+    stat = os.stat(repos_path)
+    identity = (str(repos_path), stat.st_ino, stat.st_mtime_ns)
+    listing = _repo_listing
+    if listing is not None and listing[0] == identity:
+        return listing[1]
+    names = [entry.name for entry in os.scandir(repos_path) if entry.is_dir()]
+    _repo_listing = (identity, names)
+    return names
+
+def _catalogue_state(repo_path):
+    try:
+        desc = os.stat(repo_path / "description")
+        desc_state = (desc.st_ino, desc.st_mtime_ns, desc.st_size)
+    except OSError:
+        desc_state = None
+    return (_refs_state(repo_path), desc_state)
+
+def _catalogue_entry(repo_path):
+    repo = get_repo(repo_path)
+    if not repo.bare:
+        return None
+
+    repo_info = {
+        "name": repo_path.name,
+        "path": str(repo_path.absolute()),
+        "description": "",
+        "last_updated": None
+    }
+
+    desc_file = repo_path / "description"
+    if desc_file.exists():
+        try:
+            desc = desc_file.read_text().strip()
+            if not desc.startswith("Unnamed") and not desc == "":
+                repo_info["description"] = desc
+            else:
+                repo_info["description"] = "-"
+        except:
+            pass
+
+    # HEAD's date comes from the ref snapshot, no commit read needed
+    refs = get_refs(repo_path)
+    for info in refs["branches"] + refs["tags"]:
+        if info["commit"] == refs["head"]:
+            repo_info["last_updated"] = info["date"]
+            break
+    else:
+        # detached HEAD
+        try:
+            repo_info["last_updated"] = repo.head.commit.committed_datetime
+        except:
+            pass
+
+    return repo_info
+
+@metrics.operation
 def get_repos(repos_path=None):
     if repos_path is None:
         print("repo path not set")
@@ -13,184 +334,962 @@ def get_repos(repos_path=None):
         print("repo path does not exist")
         return []
     
-    for item in repos_path.iterdir():
-        if item.is_dir():
-            try:
-                repo = git.Repo(item)
-                
-                if repo.bare:
-                    repo_info = {
-                        "name": item.name,
-                        "path": str(item.absolute()),
-                        "description": "",
-                        "last_updated": None
-                    }
-                    
-                    desc_file = item / "description"
-                    if desc_file.exists():
-                        try:
-                            desc = desc_file.read_text().strip()
-                            if not desc.startswith("Unnamed") and not desc == "":
-                                repo_info["description"] = desc
-                            else:
-                                repo_info["description"] = "-"
-                        except:
-                            pass
-                    
-                    try:
-                        latest_commit = repo.head.commit
-                        repo_info["last_updated"] = latest_commit.committed_datetime
-                    except:
-                        pass
-                    
-                    repos.append(repo_info)
-            except Exception as e:
-                print(f"error: {e}")
-                pass
+    # only repos whose HEAD, refs or description changed since the last
+    # call get looked at again, everything else is a few stat calls
+    for name in _repo_dirs(repos_path):
+        item = repos_path / name
+        try:
+            state = _catalogue_state(item)
+            with _repo_catalogue_lock:
+                cached = _repo_catalogue.get(item)
+            if cached is not None and cached[0] == state:
+                repo_info = cached[1]
+            else:
+                repo_info = _catalogue_entry(item)
+                with _repo_catalogue_lock:
+                    _repo_catalogue[item] = (state, repo_info)
+            
+            if repo_info is not None:
+                # callers add their own keys (owner), don't let them touch the cache
+                repos.append(dict(repo_info))
+        except Exception as e:
+            print(f"error: {e}")
+            with _repo_catalogue_lock:
+                _repo_catalogue.pop(item, None)
     
     return repos
 
+README_NAMES = ['README.md', 'README'] # there might be more...
+# bigger readmes are rendered from the start of the file only
+README_MAX_SIZE = int(os.getenv('README_MAX_SIZE', 512 * 1024))
+# how many tree -> readme lookups to keep
+README_LOOKUP_CACHE_SIZE = 256
+# how much rendered readme html to keep, in characters
+README_CACHE_MAX_SIZE = int(os.getenv('README_CACHE_MAX_SIZE', 8 * 1024 * 1024))
+
+# tree sha -> (name, blob sha) of its readme, or None if it has none
+_readme_lookups = OrderedDict()
+_readme_lookups_lock = threading.Lock()
+# blob sha -> sanitized html, oldest first
+_rendered_readmes = OrderedDict()
+_rendered_readmes_size = 0
+_rendered_readmes_lock = threading.Lock()
+
+def _readme_lookup(tree):
+    with _readme_lookups_lock:
+        if tree.hexsha in _readme_lookups:
+            _readme_lookups.move_to_end(tree.hexsha)
+            metrics.cache_hit("readme_lookups")
+            return _readme_lookups[tree.hexsha]
+    metrics.cache_miss("readme_lookups")
+    found = None
+    for readme_name in README_NAMES:
+        try:
+            blob = tree / readme_name
+        except KeyError:
+            continue
+        if blob.type == 'blob':
+            found = (readme_name, blob.hexsha)
+            break
+
+    with _readme_lookups_lock:
+        _readme_lookups[tree.hexsha] = found
+        while len(_readme_lookups) > README_LOOKUP_CACHE_SIZE:
+            _readme_lookups.popitem(last=False)
+    return found
+
+@metrics.operation
+def _render_readme(repo, hexsha):
+    global _rendered_readmes_size
+    with _rendered_readmes_lock:
+        html = _rendered_readmes.get(hexsha)
+        if html is not None:
+            _rendered_readmes.move_to_end(hexsha)
+            metrics.cache_hit("readmes")
+            return html
+    metrics.cache_miss("readmes")
+    text = _read_blob_prefix(repo, hexsha, README_MAX_SIZE).decode('utf-8', errors='replace')
+    # readmes are repo content, so anything that could run on our origin
+    # (scripts, event handlers, javascript: links) is stripped
+    html = nh3.clean(markdown.markdown(text, extensions=['fenced_code', 'tables']))
+
+    with _rendered_readmes_lock:
+        if hexsha not in _rendered_readmes:
+            _rendered_readmes[hexsha] = html
+            _rendered_readmes_size += len(html)
+        while _rendered_readmes_size > README_CACHE_MAX_SIZE and _rendered_readmes:
+            _, evicted = _rendered_readmes.popitem(last=False)
+            _rendered_readmes_size -= len(evicted)
+    return html
+
+@metrics.operation
 def get_readme(repo_path=None, ref='HEAD'):
+    # {"name", "hexsha", "html"} of the readme at ref, rendered once per blob
     try:
-        repo = git.Repo(repo_path)
+        repo = get_repo(repo_path)
         
         if not repo.bare:
             return None
         
-        try:
-            commit = repo.commit(ref)
-        except:
-            # sometimes HEAD is empty, if so try the next ref, if still fails, give up
-            if ref == "HEAD" and repo.heads:
-                ref = repo.heads[0].name
-                commit = repo.commit(ref)
-            else:
-                raise
-        
-        readme_names = ['README.md', 'README'] # there might be more...
-        
-        for readme_name in readme_names:
-            try:
-                blob = commit.tree / readme_name
-                return blob.data_stream.read().decode('utf-8')
-            except KeyError:
-                continue
+        commit = _resolve_commit(repo, ref)
+        found = _readme_lookup(commit.tree)
+        if found is None:
+            return None
         
-        return None
+        name, hexsha = found
+        return {
+            "name": name,
+            "hexsha": hexsha,
+            "html": _render_readme(repo, hexsha)
+        }
         
     except Exception as e:
-        print(f"error reading readme: {e}")
+        _read_failed("error reading readme", e)
         return None
 
-def get_commits(repo_path=None, max_count=20, skip=0, ref='HEAD'):
+def _resolve_commit(repo, ref):
+    # resolved in python from the ref files, doesn't spawn git
+    try:
+        return repo.commit(ref)
+    except Exception:
+        # sometimes HEAD is empty, if so try the next ref, if still fails, give up
+        if ref == "HEAD" and repo.heads:
+            return repo.commit(repo.heads[0].name)
+        raise
+
+def _parse_numstat(output):
+    # output of `git log --numstat --format=%x00%H`, one chunk per commit
+    stats = {}
+    for chunk in output.split("\x00"):
+        lines = chunk.strip("\n").split("\n")
+        if not lines[0]:
+            continue
+        insertions = 0
+        deletions = 0
+        files_changed = 0
+        for line in lines[1:]:
+            if not line:
+                continue
+            added, removed, _ = line.split("\t", 2)
+            # binary files show up as "-"
+            insertions += int(added) if added != "-" else 0
+            deletions += int(removed) if removed != "-" else 0
+            files_changed += 1
+        stats[lines[0]] = {
+            "files_changed": files_changed,
+            "insertions": insertions,
+            "deletions": deletions
+        }
+    return stats
+
+@metrics.operation
+def get_commit_stats(repo, hexshas):
+    # sha keyed, so only commits never seen before hit git
+    stats = db.get_commit_stats(hexshas)
+    missing = [hexsha for hexsha in hexshas if hexsha not in stats]
+    metrics.inc("cache_requests_total", len(hexshas) - len(missing), cache="commit_stats", result="hit")
+    metrics.inc("cache_requests_total", len(missing), cache="commit_stats", result="miss")
+    if not missing:
+        return stats
+
+    # one numstat pass for the whole batch, same numbers as commit.stats
+    # (merges against their first parent, no rename detection)
+    output = repo.git.log("--no-walk=unsorted", "--numstat", "--no-renames",
+                          "--diff-merges=first-parent", "--format=%x00%H", *missing)
+    computed = _parse_numstat(output)
+    db.save_commit_stats(computed)
+    stats.update(computed)
+    return stats
+
+# how many per-tip commit orderings to keep for cursor pagination
+COMMIT_ORDER_CACHE_SIZE = int(os.getenv('COMMIT_ORDER_CACHE_SIZE', 8))
+
+# (git dir, tip sha) -> {"shas", "index", "complete"}, oldest first
+_commit_orders = OrderedDict()
+_commit_orders_lock = threading.Lock()
+
+def _rev_list(repo, *revs, path=None, **kwargs):
+    # a path limited list only looks at commits that touch the path, git
+    # answers that from the commit-graph's changed-path bloom filters when
+    # the repo has them instead of diffing every commit
+    if path is None:
+        return repo.git.rev_list(*revs, **kwargs).split()
+    return repo.git.rev_list(*revs, "--", path, env={"GIT_LITERAL_PATHSPECS": "1"}, **kwargs).split()
+
+@metrics.operation
+def _commit_order(repo, tip, depth=0, find=None, full=False, path=None):
+    # history of a tip sha never changes, so its rev-list order is cached.
+    # only the prefix that has been asked for is kept, and it's regrown by
+    # doubling, so deep pages cost one walk to that depth per tip (and path)
+    key = (repo.git_dir, tip, path)
+    with _commit_orders_lock:
+        order = _commit_orders.get(key)
+        if order is not None:
+            _commit_orders.move_to_end(key)
+    if order is not None:
+        metrics.cache_hit("commit_orders")
+    else:
+        metrics.cache_miss("commit_orders")
+
+    def enough(order):
+        if order["complete"]:
+            return True
+        if full:
+            return False
+        if find is not None and find not in order["index"]:
+            return False
+        return len(order["shas"]) > depth
+
+    while order is None or not enough(order):
+        if full:
+            shas = _rev_list(repo, tip, path=path)
+            complete = True
+        else:
+            count = max(depth + 1, 2 * len(order["shas"]) if order else 0, 1000)
+            shas = _rev_list(repo, tip, path=path, max_count=count)
+            complete = len(shas) < count
+        order = {
+            "shas": shas,
+            "index": {sha: i for i, sha in enumerate(shas)},
+            "complete": complete
+        }
+
+    with _commit_orders_lock:
+        _commit_orders[key] = order
+        _commit_orders.move_to_end(key)
+        while len(_commit_orders) > COMMIT_ORDER_CACHE_SIZE:
+            _commit_orders.popitem(last=False)
+
+    return order
+
+def _commit_info(commit):
+    return {
+        "hexsha": commit.hexsha,
+        "author": commit.author.name,
+        "date": commit.committed_datetime,
+        "message": commit.message.strip(),
+        "files_changed": 0,
+        "insertions": 0,
+        "deletions": 0
+    }
+
+def _add_commit_stats(repo, commits):
     try:
-        repo = git.Repo(repo_path)
+        stats = get_commit_stats(repo, [c["hexsha"] for c in commits])
+        for c in commits:
+            c.update(stats.get(c["hexsha"], {}))
+    except Exception as e:
+        _read_failed("error calculating stats for commits", e)
+
+@metrics.operation
+def get_commits(repo_path=None, max_count=20, ref='HEAD'):
+    try:
+        repo = get_repo(repo_path)
         
         if not repo.bare:
             return []
         
-        try:
-            list(repo.iter_commits(ref, max_count=1))
-        except:
-            if ref == "HEAD" and repo.heads:
-                ref = repo.heads[0].name
-            else:
-                raise
+        start = _resolve_commit(repo, ref)
         
-        commits = []
-        for commit in repo.iter_commits(ref, max_count=max_count, skip=skip):
-            # lazily calculate stats with lib
-            insertions = 0
-            deletions = 0
-            files_changed = 0
-            
-            try:
-                stats = commit.stats.total
-                insertions = stats.get('insertions', 0)
-                deletions = stats.get('deletions', 0)
-                files_changed = stats.get('files', 0)
-            except Exception as e:
-                print(f"error calculating stats for commit {commit.hexsha}: {e}")
-            
-            commits.append({
-                "hexsha": commit.hexsha,
-                "author": commit.author.name,
-                "date": commit.committed_datetime,
-                "message": commit.message.strip(),
-                "files_changed": files_changed,
-                "insertions": insertions,
-                "deletions": deletions
-            })
+        commits = [_commit_info(c) for c in repo.iter_commits(start.hexsha, max_count=max_count)]
+        _add_commit_stats(repo, commits)
         
         return commits
         
     except Exception as e:
-        print(f"error reading commits: {e}")
+        _read_failed("error reading commits", e)
         return []
+
+def _commit_page(repo, tip, per_page, after, before, path=None):
+    # keyset pagination, after/before are the last/first sha of the page
+    # the user came from instead of an offset git would have to walk
+    cursor = after or before
+    page = None
     
+    if cursor is None:
+        # first page, one extra row tells if there is a next page
+        shas = _rev_list(repo, tip, path=path, max_count=per_page + 1)
+        has_next = len(shas) > per_page
+        shas = shas[:per_page]
+        has_prev = False
+        page = 1
+    else:
+        order = _commit_order(repo, tip, find=cursor, path=path)
+        position = order["index"].get(cursor)
+        
+        if position is not None:
+            start = position + 1 if after else max(position - per_page, 0)
+            order = _commit_order(repo, tip, depth=start + per_page, path=path)
+            shas = order["shas"][start:start + per_page]
+            has_next = len(order["shas"]) > start + per_page
+            has_prev = start > 0
+            page = start // per_page + 1
+        elif after:
+            # cursor isn't in this ref's history (ref was rewritten),
+            # resume from the cursor commit's parents
+            parents = [p.hexsha for p in repo.commit(after).parents]
+            shas = _rev_list(repo, *parents, path=path, max_count=per_page + 1) if parents else []
+            has_next = len(shas) > per_page
+            shas = shas[:per_page]
+            has_prev = True
+        else:
+            return None
+    
+    commits = [_commit_info(repo.commit(sha)) for sha in shas]
+    _add_commit_stats(repo, commits)
+    
+    return {
+        "commits": commits,
+        "page": page,
+        "has_next": has_next,
+        "has_prev": has_prev
+    }
+
+@metrics.operation
+def get_commit_page(repo_path=None, per_page=50, ref='HEAD', after=None, before=None):
+    empty = {"commits": [], "page": None, "has_next": False, "has_prev": False}
+    try:
+        repo = get_repo(repo_path)
+        
+        if not repo.bare:
+            return empty
+        
+        tip = _resolve_commit(repo, ref).hexsha
+        return _commit_page(repo, tip, per_page, after, before) or empty
+        
+    except Exception as e:
+        _read_failed("error reading commits", e)
+        return empty
+
+@metrics.operation
+def get_file_log(repo_path=None, file_path="", per_page=50, ref='HEAD', after=None, before=None):
+    # commits that changed file_path (a file or a dir), paginated like
+    # get_commit_page. renames aren't followed
+    empty = {"commits": [], "page": None, "has_next": False, "has_prev": False}
+    try:
+        repo = get_repo(repo_path)
+        
+        if not repo.bare or not file_path:
+            return empty
+        
+        tip = _resolve_commit(repo, ref).hexsha
+        return _commit_page(repo, tip, per_page, after, before, path=file_path) or empty
+        
+    except Exception as e:
+        _read_failed("error reading file log", e)
+        return empty
+    
+# lines of a single file diff shown before it's cut off
+DIFF_MAX_FILE_LINES = int(os.getenv('DIFF_MAX_FILE_LINES', 1000))
+# lines of diff rendered with the commit page, the rest load on demand
+DIFF_MAX_TOTAL_LINES = int(os.getenv('DIFF_MAX_TOTAL_LINES', 5000))
+# and at most this many files
+DIFF_MAX_INLINE_FILES = int(os.getenv('DIFF_MAX_INLINE_FILES', 50))
+# how many parsed file diffs to keep
+DIFF_CACHE_SIZE = int(os.getenv('DIFF_CACHE_SIZE', 256))
+# how many changed file lists to keep
+COMMIT_FILES_CACHE_SIZE = 32
+
+# root commits are diffed against the empty tree
+EMPTY_TREE_SHA = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+# same output whatever diff settings the repo config has
+_DIFF_ARGS = ("-M", "--no-color", "--no-ext-diff", "--no-textconv", "--src-prefix=a/", "--dst-prefix=b/")
+def _diff_env():
+    # paths are passed as is, not as glob patterns, and non-ascii names
+    # aren't quoted in the file headers. the setting is added after any
+    # GIT_CONFIG_* the service already sets (safe.directory)
+    count = int(os.environ.get("GIT_CONFIG_COUNT", 0))
+    return {
+        "GIT_LITERAL_PATHSPECS": "1",
+        "GIT_CONFIG_COUNT": str(count + 1),
+        f"GIT_CONFIG_KEY_{count}": "core.quotePath",
+        f"GIT_CONFIG_VALUE_{count}": "false"
+    }
+
+_DIFF_STATUSES = {"A": "new", "D": "deleted", "R": "renamed"}
+
+# commit sha -> changed files, oldest first
+_commit_files = OrderedDict()
+_commit_files_lock = threading.Lock()
+# (commit sha, path) -> parsed diff, oldest first. commits never change,
+# so neither do their diffs
+_file_diffs = OrderedDict()
+_file_diffs_lock = threading.Lock()
+
+def _diff_base(commit):
+    # merges are shown against their first parent
+    return commit.parents[0].hexsha if commit.parents else EMPTY_TREE_SHA
+
+@metrics.operation
+def _changed_files(repo, commit):
+    with _commit_files_lock:
+        files = _commit_files.get(commit.hexsha)
+        if files is not None:
+            _commit_files.move_to_end(commit.hexsha)
+            metrics.cache_hit("commit_files")
+            return files
+    metrics.cache_miss("commit_files")
+    # names, statuses and line counts of every file with one diff-tree,
+    # raw records first and then numstat records in the same order
+    output = repo.git.diff_tree("-r", "-M", "-z", "--raw", "--numstat", _diff_base(commit), commit.hexsha)
+    tokens = output.split("\x00")
+    files = []
+    counts = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token.startswith(":"):
+            status = token.split()[-1]
+            if status[0] in "RC":
+                a_path, b_path = tokens[i + 1], tokens[i + 2]
+                i += 3
+            else:
+                a_path = b_path = tokens[i + 1]
+                i += 2
+            files.append({
+                "a_path": a_path,
+                "b_path": b_path,
+                "path": b_path,
+                "status": _DIFF_STATUSES.get(status[0], "modified")
+            })
+        elif token:
+            added, removed, path = token.split("\t", 2)
+            counts.append((added, removed))
+            # renames have the two paths after an empty one
+            i += 1 if path else 3
+        else:
+            i += 1
+
+    for file, (added, removed) in zip(files, counts):
+        # binary files show up as "-"
+        file["binary"] = added == "-"
+        file["insertions"] = int(added) if added != "-" else 0
+        file["deletions"] = int(removed) if removed != "-" else 0
+
+    with _commit_files_lock:
+        _commit_files[commit.hexsha] = files
+        while len(_commit_files) > COMMIT_FILES_CACHE_SIZE:
+            _commit_files.popitem(last=False)
+    return files
+
+def _diff_lines(repo, commit, paths):
+    # patch lines of the given paths, read as git produces them so a long
+    # diff can be abandoned early
+    proc = repo.git.diff(*_DIFF_ARGS, _diff_base(commit), commit.hexsha, "--", *paths,
+                         as_process=True, env=_diff_env())
+    try:
+        for line in proc.stdout:
+            yield line.decode("utf-8", errors="replace").rstrip("\n")
+    finally:
+        proc.stdout.close()
+        proc.proc.wait()
+
+def _parse_diff(lines):
+    # patch of one file -> lines with their css class, headers dropped
+    parsed = []
+    binary = False
+    truncated = False
+    in_hunks = False
+    for line in lines:
+        if not in_hunks:
+            if line.startswith("Binary files"):
+                binary = True
+            in_hunks = line.startswith("@@")
+            if not in_hunks:
+                continue
+        if len(parsed) >= DIFF_MAX_FILE_LINES:
+            truncated = True
+            break
+        # inside a hunk the first character alone tells what a line is
+        if line.startswith("+"):
+            parsed.append(("added", line))
+        elif line.startswith("-"):
+            parsed.append(("removed", line))
+        elif line.startswith("@@"):
+            parsed.append(("hunk", line))
+        else:
+            parsed.append(("", line))
+    return {
+        "lines": parsed,
+        "binary": binary,
+        "truncated": truncated
+    }
+
+def _diff_paths(file):
+    # both sides of a rename, so git pairs them up again
+    if file["a_path"] == file["b_path"]:
+        return [file["a_path"]]
+    return [file["a_path"], file["b_path"]]
+
+@metrics.operation
+def _file_diffs_for(repo, commit, files):
+    # path -> parsed diff, everything not cached comes from one git diff
+    diffs = {}
+    missing = []
+    with _file_diffs_lock:
+        for file in files:
+            key = (commit.hexsha, file["path"])
+            if key in _file_diffs:
+                _file_diffs.move_to_end(key)
+                diffs[file["path"]] = _file_diffs[key]
+            else:
+                missing.append(file)
+    metrics.inc("cache_requests_total", len(diffs), cache="file_diffs", result="hit")
+    metrics.inc("cache_requests_total", len(missing), cache="file_diffs", result="miss")
+    if not missing:
+        return diffs
+
+    computed = {}
+    if len(missing) == 1:
+        lines = _diff_lines(repo, commit, _diff_paths(missing[0]))
+        try:
+            computed[missing[0]["path"]] = _parse_diff(lines)
+        finally:
+            lines.close()
+    else:
+        # split the combined patch on file headers. files with names git
+        # still quotes (control characters, quotes) don't match and are left
+        # to load on their own
+        headers = {f"diff --git a/{f['a_path']} b/{f['b_path']}": f["path"] for f in missing}
+        chunks = {}
+        current = None
+        for line in _diff_lines(repo, commit, [p for f in missing for p in _diff_paths(f)]):
+            if line.startswith("diff --git "):
+                current = chunks.setdefault(headers.get(line), [])
+            elif current is not None:
+                current.append(line)
+        chunks.pop(None, None)
+        for path, lines in chunks.items():
+            computed[path] = _parse_diff(lines)
+
+    with _file_diffs_lock:
+        for path, diff in computed.items():
+            _file_diffs[(commit.hexsha, path)] = diff
+        while len(_file_diffs) > DIFF_CACHE_SIZE:
+            _file_diffs.popitem(last=False)
+    diffs.update(computed)
+    return diffs
+
+@metrics.operation
 def get_commit(repo_path=None, commit_hash=None):
+    # the changed files with their stats, and diffs of the first ones up to
+    # the line budget. the rest are loaded on demand with get_file_diff
     try:
-        repo = git.Repo(repo_path)
+        repo = get_repo(repo_path)
         
         if not repo.bare:
             return None
         
         commit = repo.commit(commit_hash)
+        files = _changed_files(repo, commit)
 
-        if commit.parents:
-            parent = commit.parents[0]
-            diffs = parent.diff(commit, create_patch=True)
-        else:
-            # initial commit, no parents to compare to
-            diffs = commit.diff(git.NULL_TREE, create_patch=True)
+        inline = []
+        budget = DIFF_MAX_TOTAL_LINES
+        for file in files[:DIFF_MAX_INLINE_FILES]:
+            lines = file["insertions"] + file["deletions"]
+            if file["binary"] or lines > DIFF_MAX_FILE_LINES or lines > budget:
+                continue
+            inline.append(file)
+            budget -= lines
+
+        diffs = _file_diffs_for(repo, commit, inline) if inline else {}
+        binary_diff = {"lines": [], "binary": True, "truncated": False}
+        # files are shared through the cache, so copies get the diffs
+        files = [
+            dict(file, diff=binary_diff if file["binary"] else diffs.get(file["path"]))
+            for file in files
+        ]
         
         return {
             "commit": commit,
-            "diffs": diffs
+            "files": files,
+            "stats": {
+                "files_changed": len(files),
+                "insertions": sum(file["insertions"] for file in files),
+                "deletions": sum(file["deletions"] for file in files)
+            }
         }
         
     except Exception as e:
-        print(f"error reading commit: {e}")
+        _read_failed("error reading commit", e)
+        return None
+
+@metrics.operation
+def get_file_diff(repo_path=None, commit_hash=None, file_path=""):
+    # diff of one file changed by a commit, {"file", "diff"}
+    try:
+        repo = get_repo(repo_path)
+        
+        if not repo.bare:
+            return None
+        
+        commit = repo.commit(commit_hash)
+        for file in _changed_files(repo, commit):
+            if file["path"] == file_path:
+                return {
+                    "file": file,
+                    "diff": _file_diffs_for(repo, commit, [file])[file_path]
+                }
+        return None
+        
+    except Exception as e:
+        _read_failed("error reading diff", e)
         return None
     
+# repo path -> (refs state, snapshot)
+_ref_snapshots = {}
+_ref_snapshots_lock = threading.Lock()
+
+# one record per ref, fields split by \x1f and records ended with \x1e
+# (messages can contain newlines). * fields are the peeled commit of annotated tags
+_REF_FIELDS = [
+    "%(refname)",
+    "%(objecttype)",
+    "%(objectname)",
+    "%(committerdate:iso-strict)",
+    "%(contents)",
+    "%(*objecttype)",
+    "%(*objectname)",
+    "%(*committerdate:iso-strict)",
+    "%(*contents)",
+]
+_REF_FORMAT = "%1f".join(_REF_FIELDS) + "%1e"
+
+def _refs_state(repo_path):
+    # cheap fingerprint of everything a ref update touches. loose refs are
+    # written to a lock file and renamed into place, so the containing
+    # dir's mtime moves even when only an existing branch is updated
+    repo_path = Path(repo_path)
+    state = []
+    for name in ("HEAD", "packed-refs"):
+        try:
+            stat = os.stat(repo_path / name)
+            state.append((name, stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            state.append((name, None))
+    for dirpath, _, _ in os.walk(repo_path / "refs"):
+        try:
+            stat = os.stat(dirpath)
+            state.append((dirpath, stat.st_ino, stat.st_mtime_ns))
+        except OSError:
+            pass
+    return tuple(state)
+
+def _build_ref_snapshot(repo):
+    branches = []
+    tags = []
+    by_ref = {}
+
+    # all refs and their commits in one go instead of one object read per ref
+    output = repo.git.for_each_ref(f"--format={_REF_FORMAT}", "refs/heads", "refs/tags")
+    for record in output.split("\x1e"):
+        record = record.lstrip("\n")
+        if not record:
+            continue
+        (refname, objtype, objname, date, message,
+         peeled_type, peeled_name, peeled_date, peeled_message) = record.split("\x1f")
+
+        # annotated tag, use the commit it points to
+        if objtype == "tag":
+            objtype, objname, date, message = peeled_type, peeled_name, peeled_date, peeled_message
+        # tags can point to trees and blobs, nothing to show for those
+        if objtype != "commit":
+            continue
+
+        info = {
+            "name": refname.split("/", 2)[2],
+            "commit": objname,
+            "date": datetime.fromisoformat(date),
+            "message": message.strip()
+        }
+        by_ref[refname] = objname
+        if refname.startswith("refs/heads/"):
+            branches.append(info)
+        else:
+            tags.append(info)
+
+    # resolve HEAD from the file instead of asking git again
+    head = None
+    head_branch = None
+    try:
+        head_ref = (Path(repo.git_dir) / "HEAD").read_text().strip()
+        if head_ref.startswith("ref: "):
+            head = by_ref.get(head_ref[5:])
+            if head_ref.startswith("ref: refs/heads/"):
+                head_branch = head_ref[16:]
+        else:
+            head = head_ref
+    except OSError:
+        pass
+
+    # changes whenever any ref or HEAD moves
+    version = hashlib.sha1(f"{output}\x00{head}".encode()).hexdigest()
+
+    return {"branches": branches, "tags": tags, "head": head, "head_branch": head_branch, "version": version}
+
+def _no_refs():
+    # same shape as a snapshot, for repos that can't be read
+    return {"branches": [], "tags": [], "head": None, "head_branch": None, "version": None}
+
+@metrics.operation
 def get_refs(repo_path=None):
     try:
-        repo = git.Repo(repo_path)
+        repo = get_repo(repo_path)
         
         if not repo.bare:
-            return {"branches": [], "tags": []}
-        
-        branches = []
-        tags = []
-        
-        # branches
-        for head in repo.heads:
-            branches.append({
-                "name": head.name,
-                "commit": head.commit.hexsha,
-                "date": head.commit.committed_datetime,
-                "message": head.commit.message.strip()
-            })
-        
-        # tags
-        for tag in repo.tags:
-            tag_commit = tag.commit
-            tags.append({
-                "name": tag.name,
-                "commit": tag_commit.hexsha,
-                "date": tag_commit.committed_datetime,
-                "message": tag_commit.message.strip()
-            })
+            return _no_refs()
+
+        # only rebuild when HEAD, packed-refs or something under refs/ changed
+        state = _refs_state(repo.git_dir)
+        with _ref_snapshots_lock:
+            cached = _ref_snapshots.get(repo.git_dir)
+        if cached is not None and cached[0] == state:
+            metrics.cache_hit("refs")
+            return cached[1]
+
+        metrics.cache_miss("refs")
+        snapshot = _build_ref_snapshot(repo)
+        with _ref_snapshots_lock:
+            _ref_snapshots[repo.git_dir] = (state, snapshot)
         
-        return {"branches": branches, "tags": tags}
+        return snapshot
         
     except Exception as e:
-        print(f"error reading refs: {e}")
-        return {"branches": [], "tags": []}
+        _read_failed("error reading refs", e)
+        return _no_refs()
+
+def is_full_sha(value):
+    return len(value) == 40 and all(c in "0123456789abcdef" for c in value)
+
+def resolve_ref(repo_path=None, ref="HEAD"):
+    # commit sha of HEAD, a branch or a tag from the ref snapshot, without
+    # reading any objects. None for anything else (short shas, HEAD~2, ...)
+    if is_full_sha(ref):
+        return ref
+    refs = get_refs(repo_path)
+    if ref == "HEAD":
+        return refs["head"]
+    for info in refs["branches"] + refs["tags"]:
+        if info["name"] == ref:
+            return info["commit"]
+    return None
+
+def _has_commit(repo, hexsha):
+    # odb.has_object only sees loose objects, info asks cat-file which also
+    # finds the packed ones
+    try:
+        return repo.odb.info(bytes.fromhex(hexsha)).type == b"commit"
+    except Exception:
+        return False
+
+def commit_exists(repo_path=None, hexsha=None):
+    try:
+        repo = get_repo(repo_path)
+    except Exception:
+        return False
+    return _has_commit(repo, hexsha)
+
+# how many commits back a tree page that isn't a branch tip looks for the
+# last commits of its entries
+LAST_COMMIT_MAX_WALK = int(os.getenv('LAST_COMMIT_MAX_WALK', 2000))
+# how many of those pages to keep
+LAST_COMMIT_CACHE_SIZE = 64
+
+_LAST_COMMIT_FORMAT = "%x01%H%x1f%ct%x1f%s"
+
+# (commit sha, dir) -> (last commits of the dir's entries, whether the
+# walk found all of them), oldest first
+_dir_last_commits = OrderedDict()
+_dir_last_commits_lock = threading.Lock()
+# (git dir, branch) -> lock, so a branch is indexed by one thread at a time
+_last_commit_locks = {}
+# (git dir, branch) of the indexes being built in the background
+_last_commit_builds = set()
+_last_commit_locks_lock = threading.Lock()
+# whole history walks for new indexes, one at a time on their own thread
+# so they never take a turn from the searches and blames on the
+# expensive pool
+_last_commit_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="last-commits")
+
+def _touched_paths(repo, *args):
+    # ((hexsha, date, subject), paths) newest first from `git log --name-only`,
+    # read lazily so a walk can stop as soon as it has what it needs.
+    # merges list no paths, what they bring in shows up on the merged side
+    proc = repo.git.log("--name-only", "-z", f"--format={_LAST_COMMIT_FORMAT}", *args,
+                        as_process=True, env={"GIT_LITERAL_PATHSPECS": "1"})
+    try:
+        commit = None
+        paths = []
+        pending = b""
+        for chunk in iter(lambda: proc.stdout.read(STREAM_CHUNK_SIZE), b""):
+            tokens = (pending + chunk).split(b"\x00")
+            pending = tokens.pop()
+            for token in tokens:
+                # the path list is separated from the header by a newline
+                token = token.lstrip(b"\n")
+                if token.startswith(b"\x01"):
+                    if commit is not None:
+                        yield commit, paths
+                    hexsha, date, subject = token[1:].decode("utf-8", errors="replace").split("\x1f", 2)
+                    commit = (hexsha, int(date), subject)
+                    paths = []
+                elif token:
+                    paths.append(token.decode("utf-8", errors="replace"))
+        if commit is not None:
+            yield commit, paths
+    finally:
+        proc.stdout.close()
+        proc.proc.wait()
+
+def _assign_last_commits(found, seen, commit, paths, wanted=None):
+    # the newest commit to touch a path, or anything under a dir, is its
+    # last commit. walks go newest first, so the first one seen wins
+    for path in paths:
+        while path and path not in seen:
+            seen.add(path)
+            if wanted is None or path in wanted:
+                found[path] = commit
+            path = path.rpartition("/")[0]
+
+@metrics.operation
+def _update_last_commit_index(repo, refs, branch, tip):
+    # moves the branch's index to tip: the commits in old..tip on a fast
+    # forward, a walk back until every path of the tree is found otherwise
+    with _last_commit_locks_lock:
+        lock = _last_commit_locks.setdefault((repo.git_dir, branch), threading.Lock())
+
+    with lock:
+        old = db.get_last_commit_tip(repo.git_dir, branch)
+        if old == tip:
+            return
+
+        replace = True
+        if old is not None:
+            try:
+                repo.git.merge_base("--is-ancestor", old, tip)
+                replace = False
+            except git.GitCommandError:
+                # history was rewritten, or the old tip is gone
+                pass
+
+        found = {}
+        seen = set()
+        if replace:
+            wanted = set(_path_index(repo, repo.commit(tip).tree.hexsha)["paths"])
+            walk = _touched_paths(repo, tip)
+        else:
+            wanted = None
+            walk = _touched_paths(repo, f"{old}..{tip}")
+        try:
+            for commit, paths in walk:
+                _assign_last_commits(found, seen, commit, paths, wanted)
+                if wanted is not None and len(found) == len(wanted):
+                    break
+        finally:
+            walk.close()
+
+        db.save_last_commits(repo.git_dir, branch, old, tip, found, replace)
+        db.prune_last_commit_refs(repo.git_dir, [info["name"] for info in refs["branches"]])
+
+def _build_last_commit_index(repo_path, branch, tip):
+    # the whole history walk of a branch's first index (or after a rewrite)
+    # runs here instead of in the request that found it missing
+    try:
+        with repo_scope():
+            _update_last_commit_index(get_repo(repo_path), get_refs(repo_path), branch, tip)
+    except Exception as e:
+        print(f"error indexing last commits: {e}")
+    finally:
+        with _last_commit_locks_lock:
+            _last_commit_builds.discard((os.path.abspath(repo_path), branch))
+
+def _start_last_commit_index(repo_path, branch, tip):
+    key = (os.path.abspath(repo_path), branch)
+    with _last_commit_locks_lock:
+        if key in _last_commit_builds:
+            return
+        _last_commit_builds.add(key)
+    # a fresh context, the job outlives the request
+    _last_commit_executor.submit(contextvars.Context().run, _build_last_commit_index, repo_path, branch, tip)
+
+@metrics.operation
+def _walk_dir_last_commits(repo, commit, tree_path, paths):
+    # one pathspec limited walk for the whole dir instead of one per entry.
+    # git uses the changed-path bloom filters of the commit-graph for the
+    # pathspec when the repo has them. also whether it found every path
+    # before it stopped at LAST_COMMIT_MAX_WALK commits
+    key = (commit.hexsha, tree_path)
+    with _dir_last_commits_lock:
+        found = _dir_last_commits.get(key)
+        if found is not None:
+            _dir_last_commits.move_to_end(key)
+            metrics.cache_hit("dir_last_commits")
+            return found
+    metrics.cache_miss("dir_last_commits")
+    found = {}
+    seen = set()
+    wanted = set(paths)
+    walked = 0
+    args = [f"--max-count={LAST_COMMIT_MAX_WALK}", commit.hexsha]
+    if tree_path:
+        args += ["--", tree_path]
+    walk = _touched_paths(repo, *args)
+    try:
+        for last_commit, touched in walk:
+            walked += 1
+            _assign_last_commits(found, seen, last_commit, touched, wanted)
+            if len(found) == len(wanted):
+                break
+    finally:
+        walk.close()
+
+    # a walk that ended before the limit reached the first commit, what
+    # it didn't find isn't in the history (empty dirs of submodules...)
+    result = (found, len(found) == len(wanted) or walked < LAST_COMMIT_MAX_WALK)
+    with _dir_last_commits_lock:
+        _dir_last_commits[key] = result
+        while len(_dir_last_commits) > LAST_COMMIT_CACHE_SIZE:
+            _dir_last_commits.popitem(last=False)
+    return result
+
+def _last_commit_index_current(repo, branch, tip):
+    # whether the branch's index is at tip or only a fast forward behind it,
+    # anything else means walking the whole history
+    old = db.get_last_commit_tip(repo.git_dir, branch)
+    if old is None:
+        return False
+    if old == tip:
+        return True
+    try:
+        repo.git.merge_base("--is-ancestor", old, tip)
+        return True
+    except git.GitCommandError:
+        return False
+
+def _last_commits(repo, repo_path, ref, commit, tree_path, paths):
+    # (path -> (hexsha, date, subject), whether every path was found).
+    # branch tips (and HEAD) come from the index, anything else is walked
+    # on demand, and so are branches until their index is built
+    refs = get_refs(repo_path)
+    name = refs["head_branch"] if ref == "HEAD" else ref
+    for info in refs["branches"]:
+        if info["name"] == name and info["commit"] == commit.hexsha:
+            if _last_commit_index_current(repo, name, commit.hexsha):
+                _update_last_commit_index(repo, refs, name, commit.hexsha)
+                return db.get_last_commits(repo.git_dir, name, paths), True
+            _start_last_commit_index(repo_path, name, commit.hexsha)
+            found, complete = _walk_dir_last_commits(repo, commit, tree_path, paths)
+            if not complete:
+                # the index will have the rest
+                _read_partial("last commits being indexed")
+            return found, complete
+    return _walk_dir_last_commits(repo, commit, tree_path, paths)
 
+@metrics.operation
 def get_tree(repo_path=None, tree_path="", ref="HEAD"):
     try:
-        repo = git.Repo(repo_path)
+        repo = get_repo(repo_path)
         
         if not repo.bare:
             return None
@@ -224,62 +1323,614 @@ def get_tree(repo_path=None, tree_path="", ref="HEAD"):
 
         # dirs -> files (all alphabetically)
         entries.sort(key=lambda x: (x['type'] != 'tree', x['name'].lower()))
+
+        try:
+            last_commits, last_commits_complete = _last_commits(repo, repo_path, ref, commit, tree_path,
+                                                                [e["path"] for e in entries])
+        except Exception as e:
+            # the listing is still useful without the column
+            _read_failed("error reading last commits", e)
+            last_commits, last_commits_complete = {}, True
+        for entry in entries:
+            last_commit = last_commits.get(entry["path"])
+            entry["last_commit"] = dict(zip(("hexsha", "date", "subject"), last_commit)) if last_commit else None
         
         return {
             "entries": entries,
             "path": tree_path,
-            "is_tree": tree.type == 'tree'
+            "is_tree": tree.type == 'tree',
+            "last_commits_complete": last_commits_complete
         }
         
     except Exception as e:
-        print(f"error reading tree: {e}")
+        _read_failed("error reading tree", e)
+        return None
+
+# blobs bigger than this are shown truncated in the html view, the raw
+# endpoint always has the whole thing
+BLOB_VIEW_MAX_SIZE = int(os.getenv('BLOB_VIEW_MAX_SIZE', 512 * 1024))
+
+def _find_blob(repo, blob_path, ref):
+    commit = _resolve_commit(repo, ref)
+    try:
+        blob = commit.tree / blob_path
+    except KeyError:
+        return None
+    if blob.type != 'blob':
         return None
+    return blob
+
+def _read_blob_prefix(repo, hexsha, size):
+    # the persistent cat-file would still read the rest of the blob when
+    # we stop early, a separate process can just be closed
+    data = b""
+    chunks = _stream_process(repo, "cat-file", "blob", hexsha)
+    try:
+        for chunk in chunks:
+            data += chunk
+            if len(data) >= size:
+                break
+    finally:
+        chunks.close()
+    return data[:size]
 
+@metrics.operation
 def get_blob(repo_path=None, blob_path="", ref="HEAD"):
     try:
-        repo = git.Repo(repo_path)
+        repo = get_repo(repo_path)
+        
+        if not repo.bare:
+            return None
+        
+        blob = _find_blob(repo, blob_path, ref)
+        if blob is None:
+            return None
+        
+        # read once, and never more than the view limit
+        truncated = blob.size > BLOB_VIEW_MAX_SIZE
+        if truncated:
+            data = _read_blob_prefix(repo, blob.hexsha, BLOB_VIEW_MAX_SIZE)
+        else:
+            data = blob.data_stream.read()
+        
+        # binary is decided from the start of the file only
+        is_binary = _is_binary(data)
+        
+        return {
+            "name": blob.name,
+            "path": blob_path,
+            "size": blob.size,
+            "content": None if is_binary else data.decode('utf-8', errors='replace'),
+            "is_binary": is_binary,
+            "truncated": truncated,
+            "hexsha": blob.hexsha
+        }
+        
+    except Exception as e:
+        _read_failed("error reading blob", e)
+        return None
+
+@metrics.operation
+def get_blob_entry(repo_path=None, blob_path="", ref="HEAD"):
+    # what the raw endpoint needs before deciding to send anything
+    try:
+        repo = get_repo(repo_path)
         
         if not repo.bare:
             return None
         
+        blob = _find_blob(repo, blob_path, ref)
+        if blob is None:
+            return None
+        
+        return {
+            "name": blob.name,
+            "path": blob_path,
+            "size": blob.size,
+            "hexsha": blob.hexsha
+        }
+        
+    except Exception as e:
+        _read_failed("error reading blob", e)
+        return None
+
+def stream_blob(repo_path, hexsha):
+    # lazy, git is only started once the response body is read, after the
+    # request's own scope is gone
+    with repo_scope():
+        repo = get_repo(repo_path)
+        yield from _stream_process(repo, "cat-file", "blob", hexsha)
+    
+# lines of blame per page, every page is its own `git blame -L`
+BLAME_PAGE_LINES = int(os.getenv('BLAME_PAGE_LINES', 500))
+# how many blamed pages to keep
+BLAME_CACHE_SIZE = int(os.getenv('BLAME_CACHE_SIZE', 64))
+# bigger files aren't blamed at all
+BLAME_MAX_SIZE = int(os.getenv('BLAME_MAX_SIZE', BLOB_VIEW_MAX_SIZE))
+# how many blobs' line counts to keep
+BLAME_LINE_COUNT_CACHE_SIZE = 1024
+
+# (blob sha, commit sha, page) -> blamed lines, oldest first. the blob sha
+# alone isn't enough, the same content has another history in another commit
+_blame_pages = OrderedDict()
+# blob sha -> number of lines, None for binary, oldest first
+_blame_line_counts = OrderedDict()
+_blame_pages_lock = threading.Lock()
+
+def _blame_line_count(repo, blob):
+    # read once per blob, as a stream that stops as soon as the start of
+    # it looks binary
+    with _blame_pages_lock:
+        if blob.hexsha in _blame_line_counts:
+            _blame_line_counts.move_to_end(blob.hexsha)
+            return _blame_line_counts[blob.hexsha]
+
+    line_count = 0
+    head = b""
+    last = b""
+    chunks = _stream_process(repo, "cat-file", "blob", blob.hexsha)
+    try:
+        for chunk in chunks:
+            if len(head) < 8000:
+                head += chunk[:8000 - len(head)]
+                if _is_binary(head):
+                    line_count = None
+                    break
+            line_count += chunk.count(b"\n")
+            last = chunk[-1:]
+    finally:
+        chunks.close()
+    # git counts a last line without a newline too
+    if line_count is not None and last and last != b"\n":
+        line_count += 1
+
+    with _blame_pages_lock:
+        _blame_line_counts[blob.hexsha] = line_count
+        while len(_blame_line_counts) > BLAME_LINE_COUNT_CACHE_SIZE:
+            _blame_line_counts.popitem(last=False)
+    return line_count
+
+def _parse_blame(output):
+    # `git blame --porcelain` -> lines and the commits they come from. a
+    # commit's details are only given the first time it shows up
+    lines = []
+    commits = {}
+    hexsha = None
+    number = None
+    for line in output.decode("utf-8", errors="replace").split("\n"):
+        if line.startswith("\t"):
+            lines.append({
+                "hexsha": hexsha,
+                "number": number,
+                "text": line[1:],
+                # first line of a run from the same commit
+                "first": not lines or lines[-1]["hexsha"] != hexsha
+            })
+            continue
+        parts = line.split(" ")
+        if len(parts) in (3, 4) and is_full_sha(parts[0]):
+            hexsha = parts[0]
+            number = int(parts[2])
+            commits.setdefault(hexsha, {"author": "", "date": 0, "summary": ""})
+        elif parts[0] == "author":
+            commits[hexsha]["author"] = line[7:]
+        elif parts[0] == "author-time":
+            commits[hexsha]["date"] = int(parts[1])
+        elif parts[0] == "summary":
+            commits[hexsha]["summary"] = line[8:]
+    return lines, commits
+
+@metrics.operation
+def get_blame(repo_path=None, blob_path="", ref="HEAD", page=1):
+    # one page of blame for a file. only the page's lines are blamed, git
+    # stops walking history once all of those are accounted for, so a file
+    # with a long history is done a page at a time
+    try:
+        repo = get_repo(repo_path)
+        
+        if not repo.bare:
+            return None
+        
+        commit = _resolve_commit(repo, ref)
+        blob = _find_blob(repo, blob_path, commit.hexsha)
+        if blob is None:
+            return None
+        
+        key = (blob.hexsha, commit.hexsha, page)
+        with _blame_pages_lock:
+            blame = _blame_pages.get(key)
+            if blame is not None:
+                _blame_pages.move_to_end(key)
+                metrics.cache_hit("blame")
+                return blame
+        
+        metrics.cache_miss("blame")
+        too_large = blob.size > BLAME_MAX_SIZE
+        line_count = 0 if too_large else _blame_line_count(repo, blob)
+        is_binary = line_count is None
+        if is_binary:
+            line_count = 0
+        start = (page - 1) * BLAME_PAGE_LINES + 1
+        
+        lines = []
+        commits = {}
+        if start <= line_count:
+            end = min(start + BLAME_PAGE_LINES - 1, line_count)
+            output = repo.git.blame("--porcelain", "-L", f"{start},{end}", commit.hexsha, "--", blob_path,
+                                    env={"GIT_LITERAL_PATHSPECS": "1"}, stdout_as_string=False)
+            lines, commits = _parse_blame(output)
+        
+        blame = {
+            "name": blob.name,
+            "path": blob_path,
+            "hexsha": blob.hexsha,
+            "is_binary": is_binary,
+            "too_large": too_large,
+            "lines": lines,
+            "commits": commits,
+            "page": page,
+            "has_prev": page > 1,
+            "has_next": start + BLAME_PAGE_LINES <= line_count
+        }
+        with _blame_pages_lock:
+            _blame_pages[key] = blame
+            while len(_blame_pages) > BLAME_CACHE_SIZE:
+                _blame_pages.popitem(last=False)
+        return blame
+        
+    except Exception as e:
+        _read_failed("error reading blame", e)
+        return None
+
+# highlight blobs on the server with pygments instead of highlight.js in the browser
+SERVER_HIGHLIGHT = os.getenv('SERVER_HIGHLIGHT', '0') == '1' and pygments is not None
+if os.getenv('SERVER_HIGHLIGHT', '0') == '1' and pygments is None:
+    print("SERVER_HIGHLIGHT is set but pygments isn't installed, highlighting in the browser")
+# pygments style for the highlight stylesheet
+HIGHLIGHT_STYLE = os.getenv('HIGHLIGHT_STYLE', 'default')
+# bigger blobs are shown as plain text
+HIGHLIGHT_MAX_SIZE = int(os.getenv('HIGHLIGHT_MAX_SIZE', 256 * 1024))
+# how much highlighted html to keep, in characters
+HIGHLIGHT_CACHE_MAX_SIZE = int(os.getenv('HIGHLIGHT_CACHE_MAX_SIZE', 32 * 1024 * 1024))
+
+# (blob sha, lexer) -> highlighted html, oldest first. the same content
+# highlights the same in every repo and commit
+_highlighted = OrderedDict()
+_highlighted_size = 0
+_highlighted_lock = threading.Lock()
+
+@metrics.operation
+def highlight_blob(blob):
+    # html of a get_blob result with pygments classes, None if it should be
+    # shown as plain text
+    global _highlighted_size
+    if not SERVER_HIGHLIGHT or not blob or blob["is_binary"] or blob["truncated"]:
+        return None
+    if blob["size"] > HIGHLIGHT_MAX_SIZE:
+        return None
+
+    try:
+        # keep leading and trailing blank lines so the line numbers match
+        lexer = get_lexer_for_filename(blob["name"], stripnl=False)
+    except ClassNotFound:
+        return None
+
+    key = (blob["hexsha"], lexer.name)
+    with _highlighted_lock:
+        html = _highlighted.get(key)
+        if html is not None:
+            _highlighted.move_to_end(key)
+            metrics.cache_hit("highlight")
+            return html
+    metrics.cache_miss("highlight")
+    html = pygments.highlight(blob["content"], lexer, HtmlFormatter(nowrap=True))
+
+    with _highlighted_lock:
+        if key not in _highlighted:
+            _highlighted[key] = html
+            _highlighted_size += len(html)
+        while _highlighted_size > HIGHLIGHT_CACHE_MAX_SIZE and _highlighted:
+            _, evicted = _highlighted.popitem(last=False)
+            _highlighted_size -= len(evicted)
+    return html
+
+def highlight_css():
+    # rules for the classes highlight_blob puts out, scoped to .highlight
+    if pygments is None:
+        return ""
+    return HtmlFormatter(style=HIGHLIGHT_STYLE).get_style_defs('.highlight')
+
+# formats offered for downloads, name -> (file extension, mimetype)
+ARCHIVE_FORMATS = {
+    "zip": ("zip", "application/zip"),
+    "tar.gz": ("tar.gz", "application/gzip"),
+    "tar": ("tar", "application/x-tar"),
+}
+# finished archives are kept here when set, keyed by commit sha and format.
+# not the tree sha: git archive writes the commit id and its time into the
+# archive, two commits with the same tree don't give the same file
+ARCHIVE_CACHE_DIR = os.getenv('ARCHIVE_CACHE_DIR')
+ARCHIVE_CACHE_MAX_BYTES = int(os.getenv('ARCHIVE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _evict_cache_dir(cache_dir, max_bytes):
+    # least recently used files go first, hits bump the mtime
+    files = []
+    for entry in os.scandir(cache_dir):
+        # skip archives still being written
+        if entry.is_file() and not entry.name.startswith("."):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
         try:
-            commit = repo.commit(ref)
-        except:
-            if ref == "HEAD" and repo.heads:
-                ref = repo.heads[0].name
-                commit = repo.commit(ref)
-            else:
-                raise
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
+def _tee_to_cache(chunks, cache_path, max_bytes):
+    # pass chunks through while writing them to a hidden temp file, which is
+    # only moved into place once the whole thing went through
+    cache_dir = os.path.dirname(cache_path)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=".")
+    complete = False
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            for chunk in chunks:
+                temp_file.write(chunk)
+                yield chunk
+        complete = True
+    finally:
+        if complete:
+            os.replace(temp_path, cache_path)
+            _evict_cache_dir(cache_dir, max_bytes)
+        else:
+            # client went away or git failed
+            os.unlink(temp_path)
+
+def _feed_stdin(pipe, chunks):
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+    except (OSError, ValueError):
+        # the command exited without reading everything
+        pass
+    except Exception as e:
+        # client went away mid request, the command sees a short input
+        print(f"error reading request body: {e}")
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+# seconds a request waits for an identical one to finish a cache file
+# before building its own, when it isn't a client's request (those wait
+# like for an admission turn, see _wait_for_cache_fill)
+CACHE_FILL_WAIT = float(os.getenv('CACHE_FILL_WAIT', 120))
+
+# cache file being built -> event set when it's done (or failed)
+_cache_fills = {}
+_cache_fills_lock = threading.Lock()
+
+def _fill_cache(chunks, cache_path, max_bytes):
+    # _tee_to_cache, and requests for the same file meanwhile wait for it
+    # instead of building another. registered once the first chunk is asked
+    # for, a stream that's never sent can't leave the others waiting
+    event = threading.Event()
+    with _cache_fills_lock:
+        owner = _cache_fills.setdefault(cache_path, event) is event
+    try:
+        yield from _tee_to_cache(chunks, cache_path, max_bytes)
+    finally:
+        if owner:
+            with _cache_fills_lock:
+                _cache_fills.pop(cache_path, None)
+            event.set()
+
+def _wait_for_cache_fill(cache_path, kind, endpoint, client):
+    # whether a build of cache_path that was already running finished it.
+    # a client waiting on someone else's build counts against its share
+    # and endpoint's queue like waiting for a turn, and gets TooBusy when
+    # it takes longer than one
+    with _cache_fills_lock:
+        event = _cache_fills.get(cache_path)
+    if event is None:
+        return False
+    metrics.inc("coalesced_requests_total", kind=kind)
+    if client is None:
+        event.wait(CACHE_FILL_WAIT)
+    else:
+        admission.wait(endpoint, client, event.wait)
+    return os.path.exists(cache_path)
+
+def _stream_process(repo, command, *args, stdin=None, env=None):
+    # stdout of a git command in chunks as it's produced. stdin (chunks) is
+    # written from its own thread, so a command that starts answering before
+    # it has read everything can't deadlock with us
+    kwargs = {"as_process": True}
+    if env:
+        kwargs["env"] = env
+    if stdin is not None:
+        kwargs["istream"] = subprocess.PIPE
+    proc = getattr(repo.git, command.replace("-", "_"))(*args, **kwargs)
+    if stdin is not None:
+        threading.Thread(target=_feed_stdin, args=(proc.stdin, stdin), daemon=True).start()
+    complete = False
+    try:
+        for chunk in iter(lambda: proc.stdout.read(STREAM_CHUNK_SIZE), b""):
+            metrics.inc("bytes_streamed_total", len(chunk), command=command)
+            yield chunk
+        complete = True
+    finally:
+        proc.stdout.close()
+        status = proc.proc.wait()
+        if complete and status != 0:
+            raise RuntimeError(f"git {command} exited with {status}")
+
+@metrics.operation
+def get_archive(repo_path=None, ref="HEAD", archive_format="zip", client=None):
+    # {"path"} of a cached archive or {"stream"} of one being built, with
+    # the commit it was built from. client is who's asking, for admission
+    try:
+        repo = get_repo(repo_path)
+        
+        if not repo.bare or archive_format not in ARCHIVE_FORMATS:
+            return None
+        
+        # resolving first also keeps anything odd in ref away from the command line
+        commit = _resolve_commit(repo, ref)
+        ext, mimetype = ARCHIVE_FORMATS[archive_format]
+        archive = {"commit": commit.hexsha, "ext": ext, "mimetype": mimetype}
+        
+        cache_path = None
+        if ARCHIVE_CACHE_DIR:
+            os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+            cache_path = os.path.join(ARCHIVE_CACHE_DIR, f"{commit.hexsha}.{ext}")
+            if os.path.exists(cache_path) or _wait_for_cache_fill(cache_path, "archive", "download", client):
+                os.utime(cache_path)
+                metrics.cache_hit("archives")
+                archive["path"] = cache_path
+                return archive
+            metrics.cache_miss("archives")
         
+        chunks = _stream_process(repo, "archive", f"--format={archive_format}", commit.hexsha)
+        if cache_path:
+            chunks = _fill_cache(chunks, cache_path, ARCHIVE_CACHE_MAX_BYTES)
+        archive["stream"] = chunks
+        return archive
+        
+    except admission.TooBusy:
+        raise
+    except Exception as e:
+        print(f"error creating archive: {e}")
+        return None
+
+# packs for clones (fetches with nothing to negotiate) are kept here when
+# set, keyed by repo and the normalized request, so the same clone of the
+# same tips is only packed once
+UPLOAD_PACK_CACHE_DIR = os.getenv('UPLOAD_PACK_CACHE_DIR')
+UPLOAD_PACK_CACHE_MAX_BYTES = int(os.getenv('UPLOAD_PACK_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+# clone requests are a few wants, anything bigger is a negotiation
+UPLOAD_PACK_CACHEABLE_BODY = 64 * 1024
+
+# request tokens that differ between clients but not in the pack they get
+_PACK_KEY_IGNORED = (b"agent=", b"session-id=")
+
+def _is_protocol_v2(protocol):
+    return "version=2" in (protocol or "").split(":")
+
+def _upload_pack_env(protocol):
+    return {"GIT_PROTOCOL": protocol} if protocol else None
+
+def _pkt_lines(data):
+    # payloads of a whole pkt-line request, flush and delim packets as
+    # b"0000" and b"0001". None if it doesn't parse
+    lines = []
+    pos = 0
+    while pos < len(data):
         try:
-            blob = commit.tree / blob_path
-            
-            if blob.type != 'blob':
-                return None
-            
-            # try to read as text, if fails it's binary
-            try:
-                content = blob.data_stream.read().decode('utf-8')
-                is_binary = False
-            except UnicodeDecodeError:
-                content = blob.data_stream.read()
-                is_binary = True
-            
-            return {
-                "name": blob.name,
-                "path": blob_path,
-                "size": blob.size,
-                "content": content,
-                "is_binary": is_binary,
-                "hexsha": blob.hexsha
-            }
-        except KeyError:
+            length = int(data[pos:pos + 4], 16)
+        except ValueError:
+            return None
+        if length < 4:
+            lines.append(data[pos:pos + 4])
+            pos += 4
+        else:
+            lines.append(data[pos + 4:pos + length])
+            pos += length
+    return lines if pos == len(data) else None
+
+def _upload_pack_cache_key(repo, body, protocol):
+    lines = _pkt_lines(body)
+    if not lines:
+        return None
+    normalized = []
+    for line in lines:
+        # the pack depends on what the client already has, not worth keeping
+        if line.startswith(b"have "):
+            return None
+        tokens = [token for token in line.rstrip(b"\n").split(b" ") if not token.startswith(_PACK_KEY_IGNORED)]
+        if tokens:
+            normalized.append(b" ".join(tokens))
+    # only a request that ends the negotiation right away gets a pack back
+    if b"done" not in normalized or not any(line.startswith(b"want ") for line in normalized):
+        return None
+    if _is_protocol_v2(protocol) and normalized[0] != b"command=fetch":
+        return None
+    material = b"\x00".join([repo.git_dir.encode(), (protocol or "").encode(), b"\n".join(normalized)])
+    return hashlib.sha1(material).hexdigest()
+
+def _read_up_to(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+@metrics.operation
+def get_info_refs(repo_path=None, protocol=None):
+    # ref advertisement for smart http clients, streamed from upload-pack
+    try:
+        repo = get_repo(repo_path)
+        
+        if not repo.bare:
             return None
         
+        chunks = _stream_process(repo, "upload-pack", "--stateless-rpc", "--advertise-refs", repo.git_dir,
+                                 env=_upload_pack_env(protocol))
+        if _is_protocol_v2(protocol):
+            return chunks
+        # older protocols expect the service announced first
+        return itertools.chain([b"001e# service=git-upload-pack\n0000"], chunks)
+        
     except Exception as e:
-        print(f"error reading blob: {e}")
+        print(f"error advertising refs: {e}")
         return None
-    
+
+@metrics.operation
+def upload_pack(repo_path=None, body=None, protocol=None, client=None):
+    # answers a smart http upload-pack request read from body (a file-like,
+    # already decompressed). {"path"} of a cached response or {"stream"}.
+    # client is who's asking, for admission
+    try:
+        repo = get_repo(repo_path)
+        
+        if not repo.bare:
+            return None
+        
+        prefix = _read_up_to(body, UPLOAD_PACK_CACHEABLE_BODY + 1)
+        cache_path = None
+        if UPLOAD_PACK_CACHE_DIR and len(prefix) <= UPLOAD_PACK_CACHEABLE_BODY:
+            key = _upload_pack_cache_key(repo, prefix, protocol)
+            if key:
+                os.makedirs(UPLOAD_PACK_CACHE_DIR, exist_ok=True)
+                cache_path = os.path.join(UPLOAD_PACK_CACHE_DIR, f"{key}.pack")
+                if os.path.exists(cache_path) or _wait_for_cache_fill(cache_path, "pack", "upload-pack", client):
+                    os.utime(cache_path)
+                    metrics.cache_hit("packs")
+                    return {"path": cache_path}
+                metrics.cache_miss("packs")
+        
+        stdin = itertools.chain([prefix], iter(lambda: body.read(STREAM_CHUNK_SIZE), b""))
+        chunks = _stream_process(repo, "upload-pack", "--stateless-rpc", repo.git_dir,
+                                 stdin=stdin, env=_upload_pack_env(protocol))
+        if cache_path:
+            chunks = _fill_cache(chunks, cache_path, UPLOAD_PACK_CACHE_MAX_BYTES)
+        return {"stream": chunks}
+        
+    except admission.TooBusy:
+        raise
+    except Exception as e:
+        print(f"error running upload-pack: {e}")
+        return None
+
+@metrics.operation
 def create_bare_repo(repo_path, name, description=""):
     try:
         repo_path = Path(repo_path)
@@ -292,6 +1943,7 @@ def create_bare_repo(repo_path, name, description=""):
             }
         
         repo = git.Repo.init(new_repo_path, bare=True)
+        install_push_hook(new_repo_path)
         
         if description:
             desc_file = new_repo_path / "description"
@@ -309,140 +1961,411 @@ def create_bare_repo(repo_path, name, description=""):
             "message": f"error creating repository: {str(e)}"
         }
 
-def search_commits(repo_path=None, query="", ref='HEAD'):
+# fields of one commit for the search index, \x1f between fields and \x1e
+# after each commit since messages can contain newlines
+_COMMIT_INDEX_FORMAT = "%H%x1f%an%x1f%cn%x1f%cI%x1f%B%x1e"
+
+@metrics.operation
+def _index_commits(repo, tip):
+    # the index only grows from the tips it already covers, so a push costs
+    # the new commits, not the whole history again
+    tips = db.get_commit_index_tips(repo.git_dir)
+    if tip in tips:
+        return
+
+    proc = repo.git.log(f"--format={_COMMIT_INDEX_FORMAT}", "--ignore-missing", tip,
+                        "--not", *tips, as_process=True)
+    pending = b""
+    batch = []
+    for chunk in iter(lambda: proc.stdout.read(65536), b""):
+        records = (pending + chunk).split(b"\x1e")
+        pending = records.pop()
+        for record in records:
+            hexsha, author, committer, date, message = record.lstrip(b"\n").decode("utf-8", errors="replace").split("\x1f", 4)
+            batch.append({
+                "hexsha": hexsha,
+                "author": author,
+                "committer": committer,
+                "date": date,
+                "message": message.strip()
+            })
+        if len(batch) >= 1000:
+            db.add_commits(repo.git_dir, batch)
+            batch = []
+    proc.wait()
+    db.add_commits(repo.git_dir, batch)
+
+    # drop tips that are now part of the new tip's history
+    existing = [t for t in tips if _has_commit(repo, t)]
+    db.set_commit_index_tips(repo.git_dir, repo.git.merge_base("--independent", tip, *existing).split())
+
+def _fts_query(query):
+    # every word has to match, as a prefix, and nothing the user types is
+    # taken as fts syntax
+    words = re.findall(r"\w+", query)
+    return " ".join(f'"{word}"*' for word in words)
+
+@metrics.operation
+def search_commits(repo_path=None, query="", ref='HEAD', page=1, per_page=50):
+    empty = {"results": [], "total": 0, "page": page, "has_next": False}
     try:
-        repo = git.Repo(repo_path)
+        repo = get_repo(repo_path)
         
-        if not repo.bare or not query:
-            return []
+        match = _fts_query(query)
+        if not repo.bare or not match:
+            return empty
         
-        try:
-            list(repo.iter_commits(ref, max_count=1))
-        except:
-            if ref == "HEAD" and repo.heads:
-                ref = repo.heads[0].name
-            else:
-                raise
+        tip = _resolve_commit(repo, ref).hexsha
+        _index_commits(repo, tip)
+        # the index covers every ref of the repo, only keep what the selected
+        # ref can reach (cached per tip sha)
+        reachable = _commit_order(repo, tip, full=True)["index"]
         
         results = []
-        # maybe not wise to check all commits, but its problem for later (TODO)
-        for commit in repo.iter_commits(ref):
-            # search in commit message and author, searchin code 
-            # reference for later https://github.blog/engineering/architecture-optimization/the-technology-behind-githubs-new-code-search/
-            if (query.lower() in commit.message.lower() or 
-                query.lower() in commit.author.name.lower()):
+        total = 0
+        start = (page - 1) * per_page
+        for hexsha, author, date, message in db.search_indexed_commits(repo.git_dir, match):
+            if hexsha not in reachable:
+                continue
+            if start <= total < start + per_page:
                 results.append({
-                    "hexsha": commit.hexsha,
-                    "author": commit.author.name,
-                    "date": commit.committed_datetime,
-                    "message": commit.message.strip()
+                    "hexsha": hexsha,
+                    "author": author,
+                    "date": datetime.fromisoformat(date),
+                    "message": message
                 })
+            total += 1
                 
-        return results
+        return {
+            "results": results,
+            "total": total,
+            "page": page,
+            "has_next": total > start + per_page
+        }
         
     except Exception as e:
         print(f"error searching commits: {e}")
-        return []
+        return empty
     
-def search_files(repo_path=None, query="", ref="HEAD"):
+# how many flat path listings (one per root tree sha) are kept
+PATH_INDEX_CACHE_SIZE = int(os.getenv('PATH_INDEX_CACHE_SIZE', 8))
+# file search returns at most this many paths
+SEARCH_FILES_LIMIT = int(os.getenv('SEARCH_FILES_LIMIT', 200))
+
+# tree sha -> path index, oldest first. trees are content addressed so
+# an index is shared by every ref, commit and repo with the same tree
+_path_indexes = OrderedDict()
+_path_indexes_lock = threading.Lock()
+
+@metrics.operation
+def _path_index(repo, tree_hexsha):
+    with _path_indexes_lock:
+        index = _path_indexes.get(tree_hexsha)
+        if index is not None:
+            _path_indexes.move_to_end(tree_hexsha)
+            metrics.cache_hit("path_index")
+            return index
+    metrics.cache_miss("path_index")
+    # the whole tree, dirs included, with one ls-tree call. listed in the
+    # same order a recursive walk of the tree would give
+    output = repo.git.ls_tree("-r", "-t", "-l", "-z", "--full-tree", tree_hexsha)
+    paths = []
+    types = []
+    hexshas = []
+    sizes = []
+    for entry in output.split("\x00"):
+        if not entry:
+            continue
+        meta, path = entry.split("\t", 1)
+        _, objtype, hexsha, size = meta.split()
+        paths.append(path)
+        types.append(objtype)
+        hexshas.append(hexsha)
+        sizes.append(int(size) if objtype == "blob" else None)
+
+    # all paths lowercased in one string, so a query is a few str.find calls
+    # over it instead of a python loop over every path
+    text = "\n".join(paths).lower() + "\n"
+    starts = []
+    offset = 0
+    for path in paths:
+        starts.append(offset)
+        offset += len(path) + 1
+
+    index = {
+        "paths": paths,
+        "types": types,
+        "hexshas": hexshas,
+        "sizes": sizes,
+        "text": text,
+        "starts": starts,
+        # lowercasing can change the length of some characters, then the
+        # offsets don't line up with the text
+        "aligned": len(text) == offset
+    }
+    with _path_indexes_lock:
+        _path_indexes[tree_hexsha] = index
+        while len(_path_indexes) > PATH_INDEX_CACHE_SIZE:
+            _path_indexes.popitem(last=False)
+    return index
+
+def _path_matches(index, pattern):
+    # entries whose path matches, found over the joined text at once. when
+    # the offsets don't line up every path is checked on its own
+    if not index["aligned"]:
+        return {i for i, path in enumerate(index["paths"]) if pattern.search(path.lower())}
+
+    matches = set()
+    for match in pattern.finditer(index["text"]):
+        matches.add(bisect_right(index["starts"], match.start()) - 1)
+    return matches
+
+def _path_entry(index, i):
+    path = index["paths"][i]
+    return {
+        "name": path.rsplit("/", 1)[-1],
+        "path": path,
+        "type": index["types"][i],
+        "size": index["sizes"][i]
+    }
+
+@metrics.operation
+def search_files(repo_path=None, query="", ref="HEAD", limit=SEARCH_FILES_LIMIT):
     try:
-        repo = git.Repo(repo_path)
+        repo = get_repo(repo_path)
         
         if not repo.bare or not query:
             return []
         
-        try:
-            commit = repo.commit(ref)
-        except:
-            if ref == "HEAD" and repo.heads:
-                ref = repo.heads[0].name
-                commit = repo.commit(ref)
-            else:
-                raise
+        commit = _resolve_commit(repo, ref)
+        index = _path_index(repo, commit.tree.hexsha)
+        query = query.lower()
         
-        results = []
+        # substring anywhere in the path, or if nothing matches that, the
+        # query's characters in order (fuzzy, like most file finders)
+        matches = _path_matches(index, re.compile(re.escape(query)))
+        if not matches:
+            fuzzy = "[^\n/]*?".join(re.escape(c) for c in query)
+            matches = _path_matches(index, re.compile(fuzzy + "[^\n/]*\n"))
         
-        # recursive tree traversal, also pieces together full paths for files
-        # still very fast so no indexing for now
-        def traverse_tree(tree, current_path=""):
-            for item in tree:
-                full_path = f"{current_path}/{item.name}" if current_path else item.name
-                if query.lower() in item.name.lower():
-                    results.append({
-                        "name": item.name,
-                        "path": full_path,
-                        "type": item.type,
-                        "size": item.size if item.type == 'blob' else None
-                    })
-                if item.type == 'tree':
-                    traverse_tree(item, full_path)
-        
-        traverse_tree(commit.tree)
-        
-        return results
+        def relevance(i):
+            path = index["paths"][i].lower()
+            name = path.rsplit("/", 1)[-1]
+            if name == query:
+                rank = 0
+            elif name.startswith(query):
+                rank = 1
+            elif query in name:
+                rank = 2
+            elif query in path:
+                rank = 3
+            else:
+                rank = 4
+            return (rank, path.count("/"), len(path), i)
+        
+        return [_path_entry(index, i) for i in sorted(matches, key=relevance)[:limit]]
         
     except Exception as e:
         print(f"error searching files: {e}")
         return []
     
-def search_code(repo_path=None, query="", ref="HEAD"):
+# blobs bigger than this are neither indexed nor searched
+SEARCH_MAX_BLOB_SIZE = int(os.getenv('SEARCH_MAX_BLOB_SIZE', 1024 * 1024))
+# code search stops after this many matching files
+SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', 100))
+# threads reading blobs for search and indexing, shared by all requests
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', 4))
+# blobs per `git cat-file --batch` process
+SEARCH_BATCH_SIZE = 64
+# how many of the query's trigrams are looked up, more barely narrows it down
+CODE_INDEX_MAX_QUERY_TRIGRAMS = 12
+
+_search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+
+def _list_tree_blobs(repo, commit):
+    index = _path_index(repo, commit.tree.hexsha)
+    blobs = []
+    for i, objtype in enumerate(index["types"]):
+        # submodules are listed as commits
+        if objtype != "blob":
+            continue
+        blobs.append(_path_entry(index, i))
+        blobs[-1]["hexsha"] = index["hexshas"][i]
+    return blobs
+
+def _read_blobs(repo, hexshas):
+    # many blobs through one `git cat-file --batch`, yields (hexsha, data).
+    # the shas fit in the pipe buffer, so all of them are written up front
+    proc = repo.git.cat_file("--batch", as_process=True, istream=subprocess.PIPE)
     try:
-        repo = git.Repo(repo_path)
+        proc.stdin.write("".join(f"{hexsha}\n" for hexsha in hexshas).encode())
+        proc.stdin.close()
+        for hexsha in hexshas:
+            header = proc.stdout.readline().split()
+            if len(header) < 3:
+                # missing object
+                continue
+            data = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)  # trailing newline
+            yield hexsha, data
+    finally:
+        # if we stopped early cat-file gets EPIPE and exits
+        proc.stdout.close()
+        proc.proc.wait()
+
+def _batches(items, size=SEARCH_BATCH_SIZE):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _is_binary(data):
+    # same check git uses, a NUL byte near the start
+    return b"\x00" in data[:8000]
+
+def _trigrams(text):
+    # 3 chars packed into one int, 21 bits covers every code point
+    return {
+        (ord(text[i]) << 42) | (ord(text[i + 1]) << 21) | ord(text[i + 2])
+        for i in range(len(text) - 2)
+    }
+
+def _blob_trigrams(repo, hexshas):
+    entries = []
+    for hexsha, data in _read_blobs(repo, hexshas):
+        # binary blobs are indexed with no trigrams, they never match
+        if _is_binary(data):
+            entries.append((hexsha, set()))
+        else:
+            entries.append((hexsha, _trigrams(data.decode("utf-8", errors="ignore").lower())))
+    return entries
+
+@metrics.operation
+def _index_code_blobs(repo, blobs):
+    # only blobs never seen before are read, everything already indexed
+    # for another ref, commit or repo is reused
+    wanted = {b["hexsha"] for b in blobs if b["size"] <= SEARCH_MAX_BLOB_SIZE}
+    missing = sorted(wanted - db.get_indexed_code_blobs(wanted))
+
+    futures = [_search_executor.submit(contextvars.copy_context().run, _blob_trigrams, repo, batch) for batch in _batches(missing)]
+    for future in futures:
+        db.add_code_blobs(future.result())
+
+def _index_code_tree(repo, commit):
+    # the searchable blobs of the commit, indexed first if the tree isn't yet
+    blobs = [b for b in _list_tree_blobs(repo, commit) if b["size"] <= SEARCH_MAX_BLOB_SIZE]
+
+    tree_hexsha = commit.tree.hexsha
+    if not db.is_code_tree_indexed(tree_hexsha):
+        _index_code_blobs(repo, blobs)
+        db.mark_code_tree_indexed(tree_hexsha)
+    return blobs
+
+def _code_candidates(repo, commit, query):
+    blobs = _index_code_tree(repo, commit)
+
+    trigrams = sorted(_trigrams(query))
+    # too short to narrow anything down
+    if not trigrams:
+        return blobs
+
+    # spread the picked trigrams over the whole query
+    step = max(len(trigrams) // CODE_INDEX_MAX_QUERY_TRIGRAMS, 1)
+    matches = db.find_code_blobs(trigrams[::step][:CODE_INDEX_MAX_QUERY_TRIGRAMS])
+
+    return [b for b in blobs if b["hexsha"] in matches]
+
+def _matching_lines(content, query):
+    lowered = content.lower()
+    # lower() can change the length of some characters, then offsets into
+    # the lowered text don't line up with the original, go line by line
+    if len(lowered) != len(content):
+        return [
+            {'line_number': i, 'content': line.strip()}
+            for i, line in enumerate(content.split('\n'), 1)
+            if query in line.lower()
+        ]
+
+    # jump from match to match instead of splitting the whole file
+    matching_lines = []
+    line_number = 1
+    counted_to = 0
+    position = lowered.find(query)
+    while position != -1:
+        line_number += lowered.count('\n', counted_to, position)
+        line_start = lowered.rfind('\n', 0, position) + 1
+        line_end = lowered.find('\n', position)
+        if line_end == -1:
+            line_end = len(lowered)
+        matching_lines.append({
+            'line_number': line_number,
+            'content': content[line_start:line_end].strip()
+        })
+        counted_to = line_end
+        position = lowered.find(query, line_end)
+    return matching_lines
+
+def _search_blobs(repo, blobs, query):
+    results = []
+    by_sha = {}
+    for item in blobs:
+        by_sha.setdefault(item["hexsha"], []).append(item)
+
+    for hexsha, data in _read_blobs(repo, list(by_sha)):
+        # sniff the start, binaries are never decoded
+        if _is_binary(data):
+            continue
+        matching_lines = _matching_lines(data.decode('utf-8', errors='ignore'), query)
+        if matching_lines:
+            for item in by_sha[hexsha]:
+                results.append({
+                    "name": item["name"],
+                    "path": item["path"],
+                    "type": "blob",
+                    "size": item["size"],
+                    "matching_lines": matching_lines
+                })
+
+    # back to tree order
+    order = {item["path"]: i for i, item in enumerate(blobs)}
+    results.sort(key=lambda r: order[r["path"]])
+    return results
+
+@metrics.operation
+def search_code(repo_path=None, query="", ref="HEAD", limit=SEARCH_MAX_RESULTS):
+    empty = {"results": [], "truncated": False}
+    try:
+        repo = get_repo(repo_path)
         
         if not repo.bare or not query:
-            return []
+            return empty
         
-        try:
-            commit = repo.commit(ref)
-        except:
-            if ref == "HEAD" and repo.heads:
-                ref = repo.heads[0].name
-                commit = repo.commit(ref)
-            else:
-                raise
+        commit = _resolve_commit(repo, ref)
+        query = query.lower()
+        
+        # the trigram index narrows the tree down to blobs that can contain the
+        # query, only those are read, in batches spread over the search threads
+        futures = [
+            _search_executor.submit(contextvars.copy_context().run, _search_blobs, repo, batch, query)
+            for batch in _batches(_code_candidates(repo, commit, query))
+        ]
         
         results = []
+        truncated = False
+        for future in futures:
+            # enough already, batches that haven't started are dropped
+            if truncated:
+                future.cancel()
+                continue
+            results.extend(future.result())
+            if len(results) > limit:
+                results = results[:limit]
+                truncated = True
         
-        # recursive tree traversal to search file contents, not even thinking about optimizations
-        def traverse_tree(tree, current_path=""):
-            for item in tree:
-                full_path = f"{current_path}/{item.name}" if current_path else item.name
-                if item.type == 'blob':
-                    try:
-                        # only search text files, skip binary files by exception
-                        blob_content = item.data_stream.read().decode('utf-8', errors='ignore')
-                        if query.lower() in blob_content.lower():
-                            # find the line numbers where the query appears
-                            lines = blob_content.split('\n')
-                            matching_lines = []
-                            for i, line in enumerate(lines, 1):
-                                if query.lower() in line.lower():
-                                    matching_lines.append({
-                                        'line_number': i,
-                                        'content': line.strip()
-                                    })
-                            
-                            results.append({
-                                "name": item.name,
-                                "path": full_path,
-                                "type": item.type,
-                                "size": item.size,
-                                "matching_lines": matching_lines 
-                            })
-                    except UnicodeDecodeError:
-                        # skip binary 
-                        pass
-                elif item.type == 'tree':
-                    traverse_tree(item, full_path)
-        
-        traverse_tree(commit.tree)
-        
-        return results
+        return {"results": results, "truncated": truncated}
         
     except Exception as e:
         print(f"error searching code: {e}")
-        return []
+        return empty
 
+@metrics.operation
 def set_repo_description(repo_path, description):
     try:
         repo_path = Path(repo_path)
@@ -452,3 +2375,155 @@ def set_repo_description(repo_path, description):
     except Exception as e:
         print(f"error setting description: {e}")
         return False
+
+# the post-receive hook create_bare_repo installs writes one file per push
+# here (the repo and its "old new ref" lines), whichever worker renames it
+# first warms the caches and indexes for the new tips
+PUSH_SPOOL_DIR = os.getenv('PUSH_SPOOL_DIR', os.path.join(os.path.dirname(db.DB_PATH), "push-spool"))
+# seconds between looks at the spool dir
+PUSH_POLL_INTERVAL = float(os.getenv('PUSH_POLL_INTERVAL', 2))
+# a claimed push still there after this many seconds belonged to a worker
+# that died, it's taken again
+PUSH_CLAIM_TIMEOUT = 600
+
+ZERO_SHA = "0" * 40
+
+_POST_RECEIVE_HOOK_MARKER = "# installed by git-webview"
+_POST_RECEIVE_HOOK = """#!/bin/sh
+{marker}, tells it which refs moved so the pages are warm
+# before anyone opens them. never fails the push
+spool={spool}
+input=$(cat)
+mkdir -p "$spool" 2>/dev/null
+tmp="$spool/.$$.tmp"
+{{ pwd; printf '%s\\n' "$input"; }} > "$tmp" 2>/dev/null && mv "$tmp" "$spool/$(date +%s)-$$.push" 2>/dev/null
+# the hook that was here before, with the same input
+if [ -x "$0.orig" ]; then
+    printf '%s\\n' "$input" | "$0.orig" "$@"
+    exit $?
+fi
+exit 0
+"""
+
+_push_worker = None
+
+def install_push_hook(repo_path):
+    # a post-receive hook of someone else's (mirroring, ci) is kept as
+    # post-receive.orig and still run by ours
+    hook = Path(repo_path) / "hooks" / "post-receive"
+    original = hook.with_name("post-receive.orig")
+    hook.parent.mkdir(exist_ok=True)
+    if hook.exists() and _POST_RECEIVE_HOOK_MARKER not in hook.read_text(errors="replace"):
+        if original.exists():
+            raise RuntimeError(f"{hook} and {original} both exist, not replacing either")
+        hook.rename(original)
+    hook.write_text(_POST_RECEIVE_HOOK.format(marker=_POST_RECEIVE_HOOK_MARKER,
+                                              spool=shlex.quote(os.path.abspath(PUSH_SPOOL_DIR))))
+    hook.chmod(0o755)
+
+def _claim_pushes():
+    # rename is atomic, only one worker (or process) gets each file
+    try:
+        entries = sorted(os.scandir(PUSH_SPOOL_DIR), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return []
+
+    claimed = []
+    now = time.time()
+    for entry in entries:
+        if entry.name.endswith(".working"):
+            try:
+                if now - entry.stat().st_mtime < PUSH_CLAIM_TIMEOUT:
+                    continue
+            except OSError:
+                continue
+        elif not entry.name.endswith(".push"):
+            # half written by the hook
+            continue
+        name = entry.name.split(".push")[0]
+        path = os.path.join(PUSH_SPOOL_DIR, f"{name}.push.{os.getpid()}.{threading.get_ident()}.working")
+        try:
+            os.rename(entry.path, path)
+            # the claim's age, for the timeout above
+            os.utime(path)
+        except OSError:
+            # someone else was faster
+            continue
+        claimed.append(path)
+    return claimed
+
+def _read_push(path):
+    with open(path) as f:
+        lines = f.read().splitlines()
+    updates = [tuple(line.split(" ", 2)) for line in lines[1:] if line.count(" ") >= 2]
+    return (lines[0] if lines else ""), updates
+
+@metrics.operation
+def warm_push(repos_path, pushed_path, updates):
+    # what the first views of the pushed refs would compute: ref snapshot,
+    # catalogue, commit search index, code and path indexes, last commit
+    # index and first commit page per branch, and the overview and readme
+    # for HEAD. everything else is keyed by object sha and needs no
+    # invalidation
+    repos_path = Path(repos_path)
+    pushed_path = Path(pushed_path).resolve()
+    if pushed_path.parent != repos_path.resolve():
+        print(f"push for a repo outside the repo root: {pushed_path}")
+        return
+    # the same path the routes use, the caches are keyed by it
+    repo_path = str(repos_path / pushed_path.name)
+
+    repo = get_repo(repo_path)
+    refs = get_refs(repo_path)
+    get_repos(repos_path)
+
+    commits = {info["name"]: info["commit"] for info in refs["tags"]}
+    branches = {info["name"]: info["commit"] for info in refs["branches"]}
+    commits.update(branches)
+    for old, new, refname in updates:
+        name = refname.split("/", 2)[-1]
+        tip = commits.get(name)
+        if new == ZERO_SHA or tip is None:
+            continue
+        _index_commits(repo, tip)
+        _index_code_tree(repo, repo.commit(tip))
+        if refname.startswith("refs/heads/") and branches.get(name) == tip:
+            _update_last_commit_index(repo, refs, name, tip)
+            get_commit_page(repo_path, ref=name)
+
+    if any(new == ZERO_SHA for _, new, _ in updates):
+        db.prune_last_commit_refs(repo.git_dir, list(branches))
+
+    if refs["head_branch"] in [refname[11:] for _, _, refname in updates if refname.startswith("refs/heads/")]:
+        get_commits(repo_path)
+        get_readme(repo_path)
+        get_tree(repo_path)
+
+def start_push_worker(repos_path):
+    # one per process, under gunicorn every worker runs one and they share
+    # the spool. the db indexes are shared by all of them, the in-memory
+    # caches only warm in the worker that claimed the push
+    global _push_worker
+    if _push_worker is not None:
+        return
+
+    def work():
+        while True:
+            for path in _claim_pushes():
+                try:
+                    pushed_path, updates = _read_push(path)
+                    with repo_scope():
+                        run_expensive(warm_push, repos_path, pushed_path, updates)
+                except FileNotFoundError:
+                    # taken over by another worker
+                    continue
+                except Exception as e:
+                    print(f"error warming push: {e}")
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            time.sleep(PUSH_POLL_INTERVAL)
+
+    _push_worker = threading.Thread(target=work, name="push-worker", daemon=True)
+    _push_worker.start()